@@ -0,0 +1,34 @@
+"""Bake a fast-boot snapshot of the IndexTTS model.
+
+Loads the model from INDEX_TTS_MODEL_DIR the way a worker does (eager FP32, one warm-up
+shape to check that it synthesizes) and writes it to the snapshot directory: GPT and
+BigVGAN weights as safetensors, config.yaml, the BPE model, the default voice
+conditioning and a manifest. Workers boot from it with INDEX_TTS_SNAPSHOT_DIR=<dir>.
+
+Usage:
+    python bake_snapshot.py /app/snapshot
+"""
+import os
+import sys
+
+# Snapshots hold the plain FP32 weights, always baked from the checkpoints
+os.environ["INDEX_TTS_QUANTIZE"] = "0"
+os.environ["INDEX_TTS_COMPILE"] = "0"
+os.environ.pop("INDEX_TTS_SNAPSHOT_DIR", None)
+os.environ.setdefault("INDEX_TTS_WARMUP_BUDGET_S", "0")
+
+from tts_server import IndexTtsServer, setup_logging
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(2)
+    setup_logging()
+    server = IndexTtsServer()
+    server.bake_snapshot(sys.argv[1])
+    server.context.destroy(linger=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Benchmark int8 dynamic quantization against FP32 for CPU inference.
+
+Synthesizes a fixed text set with an FP32 worker and an INDEX_TTS_QUANTIZE=int8 worker
+and reports per-text real-time factor (synthesis seconds / audio seconds) and how
+similar the int8 output is to FP32 (DTW-aligned MFCC cosine similarity, duration ratio).
+
+Usage:
+    python benchmark_quantization.py [texts.txt]   # one text per line
+"""
+import gc
+import io
+import os
+import sys
+import time
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+# Both runs are CPU, FP32 activations, and must not be served from the caches
+os.environ.setdefault("DEVICE", "cpu")
+os.environ["INDEX_TTS_PRECISION"] = "fp32"
+os.environ["INDEX_TTS_RESULT_CACHE_MB"] = "0"
+os.environ["INDEX_TTS_SENTENCE_CACHE_MB"] = "0"
+
+from tts_server import IndexTtsServer, setup_logging
+
+BENCHMARK_TEXTS = [
+    "测试",
+    "您好，欢迎使用雨燕租车。",
+    "安排验车：商家会指派验车人员，并与您协商确定具体的验车时间和地点。",
+    "Hello, this is an English TTS test.",
+    "The quick brown fox jumps over the lazy dog, and then it runs back into the forest before sunset.",
+    "如果您在取车时发现车辆有任何问题，请立即联系客服，我们会在第一时间为您处理，并提供替代方案。",
+]
+
+
+def synthesize_all(quantize, texts):
+    """[(seconds, float samples, sample rate)] for each text"""
+    os.environ["INDEX_TTS_QUANTIZE"] = "int8" if quantize else "0"
+    server = IndexTtsServer()
+    results = []
+    for text in texts:
+        start_time = time.perf_counter()
+        status_msg, audio_data = server.process_text(text, use_cache=False)
+        elapsed = time.perf_counter() - start_time
+        if not audio_data:
+            raise RuntimeError(f"Synthesis failed for {text!r}: {status_msg}")
+        samples, sampling_rate = sf.read(io.BytesIO(audio_data), dtype="float32")
+        results.append((elapsed, samples, sampling_rate))
+    server.context.destroy(linger=0)
+    del server
+    gc.collect()
+    return results
+
+
+def similarity(reference, candidate, sampling_rate):
+    """Mean cosine similarity of MFCC frames after DTW alignment (1.0 = identical)"""
+    ref_mfcc = librosa.feature.mfcc(y=reference, sr=sampling_rate, n_mfcc=20)
+    cand_mfcc = librosa.feature.mfcc(y=candidate, sr=sampling_rate, n_mfcc=20)
+    _, path = librosa.sequence.dtw(X=ref_mfcc, Y=cand_mfcc, metric="cosine")
+    ref_frames = ref_mfcc[:, path[:, 0]]
+    cand_frames = cand_mfcc[:, path[:, 1]]
+    cosine = np.sum(ref_frames * cand_frames, axis=0) / (
+        np.linalg.norm(ref_frames, axis=0) * np.linalg.norm(cand_frames, axis=0) + 1e-8)
+    return float(np.mean(cosine))
+
+
+def main():
+    setup_logging()
+    texts = BENCHMARK_TEXTS
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    print("Running FP32 baseline...")
+    baseline = synthesize_all(False, texts)
+    print("Running int8 dynamic quantization...")
+    quantized = synthesize_all(True, texts)
+
+    print(f"\n{'text':<32} {'RTF fp32':>9} {'RTF int8':>9} {'speedup':>8} {'similarity':>11} {'dur ratio':>10}")
+    totals = {"fp32_time": 0.0, "int8_time": 0.0, "fp32_audio": 0.0, "int8_audio": 0.0}
+    similarities = []
+    for text, (fp32_time, fp32_wav, sr), (int8_time, int8_wav, _) in zip(texts, baseline, quantized):
+        fp32_seconds = len(fp32_wav) / sr
+        int8_seconds = len(int8_wav) / sr
+        score = similarity(fp32_wav, int8_wav, sr)
+        similarities.append(score)
+        totals["fp32_time"] += fp32_time
+        totals["int8_time"] += int8_time
+        totals["fp32_audio"] += fp32_seconds
+        totals["int8_audio"] += int8_seconds
+        label = text if len(text) <= 30 else text[:29] + "…"
+        print(f"{label:<32} {fp32_time / fp32_seconds:>9.3f} {int8_time / int8_seconds:>9.3f} "
+              f"{fp32_time / int8_time:>7.2f}x {score:>11.3f} {int8_seconds / fp32_seconds:>10.2f}")
+
+    print(f"\nOverall RTF: fp32 {totals['fp32_time'] / totals['fp32_audio']:.3f}, "
+          f"int8 {totals['int8_time'] / totals['int8_audio']:.3f} "
+          f"({totals['fp32_time'] / totals['int8_time']:.2f}x faster), "
+          f"mean similarity {np.mean(similarities):.3f}")
+
+
+if __name__ == "__main__":
+    main()
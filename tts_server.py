@@ -1,207 +1,2371 @@
+import atexit
+import bisect
+import concurrent.futures
+import contextlib
+import gc
+import hashlib
+import http.server
+import math
+import io
+import json
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import random
+import shutil
+import signal
 import sys
 import tempfile
+import threading
+import unicodedata
+import wave
 import zmq
+from zmq.utils.monitor import recv_monitor_message
+import numpy as np
+import soundfile as sf
 import torch
+import torchaudio
 import time
+from collections import OrderedDict, deque
 
-# ✅ Set HuggingFace mirror endpoint for China
-os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
-# Ensure online mode for runtime downloads
-os.environ["TRANSFORMERS_OFFLINE"] = "0"
-os.environ["HF_HUB_OFFLINE"] = "0"
+try:
+    import msgpack  # optional: msgpack request payloads
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger("tts_server")
+
+# Offline-first (the production default): every asset comes from INDEX_TTS_MODEL_DIR and
+# the HuggingFace libraries are told not to make network calls. These must be set before
+# indextts imports transformers.
+OFFLINE = os.environ.get('INDEX_TTS_OFFLINE', '1') == '1'
+if OFFLINE:
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+    os.environ["HF_DATASETS_OFFLINE"] = "1"
+else:
+    # ✅ Set HuggingFace mirror endpoint for China, online mode for runtime downloads
+    os.environ.setdefault("HF_ENDPOINT", "https://hf-mirror.com")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "0")
+    os.environ.setdefault("HF_HUB_OFFLINE", "0")
 
 # Add IndexTTS to path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(current_dir, "index-tts"))
 
+_import_start = time.perf_counter()
 from indextts.infer import IndexTTS
+from indextts.BigVGAN.models import BigVGAN as Generator
+from indextts.gpt.model import UnifiedVoice
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+from indextts.utils.front import TextNormalizer, TextTokenizer
+from omegaconf import OmegaConf
+from safetensors.torch import load_file, save_file
+IMPORT_SECONDS = time.perf_counter() - _import_start
+
+# IndexTTS always produces 24 kHz audio
+SAMPLING_RATE = 24000
+
+# Named speed/quality presets for the inference parameters. "balanced" is the set
+# tuned for production on a T4. Precision "auto" follows INDEX_TTS_PRECISION and the
+# device, see resolve_precision.
+PRESETS = {
+    "balanced": {
+        "max_text_tokens_per_sentence": 100,
+        "sentences_bucket_max_size": 4,
+        "do_sample": False,  # for production T4 GPU
+        "top_p": 0.8,
+        "top_k": 30,
+        "temperature": 1.0,
+        "length_penalty": 0.0,
+        "num_beams": 1,  # original num_beams is 3
+        "repetition_penalty": 10.0,
+        "max_mel_tokens": 600,
+        "precision": "auto",
+    },
+}
+# Latency-critical chat turns: shorter sentences so the first one is ready sooner, wider buckets
+PRESETS["realtime"] = dict(PRESETS["balanced"], max_text_tokens_per_sentence=60,
+                           sentences_bucket_max_size=8, max_mel_tokens=500)
+# Offline narration: IndexTTS' original beam search, longer sentences, full precision
+PRESETS["quality"] = dict(PRESETS["balanced"], max_text_tokens_per_sentence=120,
+                          sentences_bucket_max_size=2, num_beams=3, max_mel_tokens=800,
+                          precision="fp32")
+PRECISIONS = ("auto", "fp16", "bf16", "fp32")
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": None}
+
+
+# How request text appears in logs, set by setup_logging from INDEX_TTS_LOG_TEXT /
+# INDEX_TTS_LOG_TEXT_CHARS: "hash" (sha256 prefix + length), "truncate", "full" or "none"
+LOG_SETTINGS = {"text": "hash", "text_chars": 32}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, thread, message, request id and any `fields`"""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for local runs; structured fields are appended as JSON"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = dict(getattr(record, "fields", None) or {})
+        if getattr(record, "request_id", None):
+            fields["request_id"] = record.request_id
+        return f"{line} {json.dumps(fields, ensure_ascii=False, default=str)}" if fields else line
+
+
+class SuccessSampler(logging.Filter):
+    """Keeps only `rate` of the records logged with extra={"sampled": True} (per-request success lines)"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, "sampled", False) or random.random() < self.rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records when the queue is full instead of blocking the logging thread"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    """Route all logging through a bounded queue to a writer thread, so no caller ever waits on stderr.
+
+    INDEX_TTS_LOG_LEVEL sets the level, INDEX_TTS_LOG_FORMAT picks json (default) or text,
+    INDEX_TTS_LOG_SAMPLE_SUCCESS the fraction of per-request success lines kept.
+    Returns the queue listener. It is stopped (flushing the queue) at exit, but a process
+    that leaves through os._exit, like a forked worker, must stop it itself.
+    """
+    formatter = JsonFormatter() if os.environ.get('INDEX_TTS_LOG_FORMAT', 'json') == 'json' else TextFormatter()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+    log_queue = queue.Queue(maxsize=max(1, int(os.environ.get('INDEX_TTS_LOG_QUEUE_SIZE', '10000'))))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SuccessSampler(float(os.environ.get('INDEX_TTS_LOG_SAMPLE_SUCCESS', '1'))))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(os.environ.get('INDEX_TTS_LOG_LEVEL', 'INFO').upper())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    LOG_SETTINGS["text"] = os.environ.get('INDEX_TTS_LOG_TEXT', 'hash')
+    LOG_SETTINGS["text_chars"] = int(os.environ.get('INDEX_TTS_LOG_TEXT_CHARS', '32'))
+    return listener
+
+
+def text_fields(text_data):
+    """Log fields describing request text, per LOG_SETTINGS["text"]"""
+    mode = LOG_SETTINGS["text"]
+    fields = {"chars": len(text_data)}
+    if mode == "full":
+        fields["text"] = text_data
+    elif mode == "truncate":
+        limit = LOG_SETTINGS["text_chars"]
+        fields["text"] = text_data if len(text_data) <= limit else text_data[:limit] + "…"
+    elif mode == "hash":
+        fields["text_sha256"] = hashlib.sha256(text_data.encode('utf-8')).hexdigest()[:16]
+    return fields
+
+
+def cpu_supports_bf16():
+    """True if the CPU has native bf16 math (AVX512-BF16 or AMX); emulated bf16 is slower than fp32"""
+    try:
+        with open("/proc/cpuinfo", 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def resolve_precision(precision, device, worker_precision="auto"):
+    """Concrete autocast precision for a device: "auto" means the worker setting, and an
+    "auto" worker setting means FP16 on CUDA, bf16 on CPUs that support it, FP32 otherwise"""
+    if precision == "auto":
+        precision = worker_precision
+    if device.startswith("cuda"):
+        if precision == "auto":
+            return "fp16"
+        if precision == "bf16" and not torch.cuda.is_bf16_supported():
+            return "fp16"
+        return precision
+    # CPU autocast has no useful FP16 path, so FP16 is treated like auto there
+    if precision in ("auto", "fp16"):
+        return "bf16" if cpu_supports_bf16() else "fp32"
+    if precision == "bf16" and not cpu_supports_bf16():
+        return "fp32"
+    return precision
+
+
+def load_presets(presets_file=None):
+    """Built-in presets, plus any from a JSON file of {name: {param: value}}.
+
+    File entries replace or add presets; parameters they leave out come from "balanced".
+    """
+    presets = {name: dict(params) for name, params in PRESETS.items()}
+    if presets_file:
+        with open(presets_file, 'r', encoding='utf-8') as f:
+            for name, overrides in json.load(f).items():
+                unknown = set(overrides) - set(PRESETS["balanced"])
+                if unknown:
+                    raise ValueError(f"preset {name!r} has unknown parameters: {sorted(unknown)}")
+                presets[name] = dict(PRESETS["balanced"], **overrides)
+    for name, params in presets.items():
+        if params["precision"] not in PRECISIONS:
+            raise ValueError(f"preset {name!r} has invalid precision {params['precision']!r}")
+    return presets
+
+# Streaming replies: envelope + [audio, STREAM_CHUNK, seq] per sentence,
+# then envelope + [b"", STREAM_END, chunk count] (or STREAM_ERROR on failure)
+STREAM_CHUNK = b"CHUNK"
+STREAM_END = b"END"
+STREAM_ERROR = b"ERROR"
+STREAM_REQUEST_FLAG = b"stream"
+
+# Inference thread -> I/O thread reply channel
+REPLY_PIPE_URL = "inproc://tts-replies"
+
+# Worker readiness: loading -> warming -> ready -> draining. The worker registers with
+# the broker only on entering ready; a failed warm-up ends in failed, never registered.
+STATE_LOADING = "loading"
+STATE_WARMING = "warming"
+STATE_READY = "ready"
+STATE_DRAINING = "draining"
+STATE_FAILED = "failed"
+
+# Application-level heartbeat: the worker sends [service name, HEARTBEAT]; any message
+# from the broker with fewer than 4 frames (e.g. [HEARTBEAT]) is control, not a request
+HEARTBEAT = b"HEARTBEAT"
+
+# Per-request latency stages, in pipeline order. "total" runs from receipt to the last
+# reply frame; "send" is measured per message in the I/O thread.
+STAGES = ("queue_wait", "normalize", "tokenize", "conditioning", "gpt_decode", "gpt_latent",
+          "vocoder", "encode", "send", "total")
+# Histogram bucket upper bounds: seconds, and mel tokens generated per request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MEL_TOKEN_BUCKETS = (25, 50, 100, 200, 400, 800, 1200, 1600, 2400, 3200)
+# Real-time factor (synthesis seconds / audio seconds) buckets; below 1 is faster than real time
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0)
+# Fields of a request's cost record that are summed over the rolling windows
+COST_FIELDS = ("chars", "text_tokens", "mel_tokens", "audio_seconds", "synthesis_seconds")
+
+
+# Default warm-up grid: short/medium/long, Chinese/English/mixed texts, each run at several
+# batch sizes so allocator growth, kernel selection and compilation happen before traffic
+WARMUP_TEXTS = [
+    "测试",
+    "您好，欢迎使用雨燕租车。",
+    "Hello, this is a warm-up test.",
+    "您的订单号是 A1024，预计 3 pm 可以取车。",
+    "安排验车：商家会指派验车人员，并与您协商确定具体的验车时间和地点，请您保持电话畅通。"
+    "如果您在取车时发现车辆有任何问题，请立即联系客服，我们会在第一时间为您处理。",
+    "Thank you for choosing our service. Your car will be ready at the main entrance, "
+    "and our staff will walk you through the inspection before you drive away.",
+]
+
+# Reply encodings a request may ask for; "pcm" is raw 16-bit little-endian mono
+OUTPUT_FORMATS = ("wav", "pcm", "flac", "ogg")
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 48000
+
+
+def parse_payload(payload):
+    """Decode a request payload: a JSON object, a msgpack map or (as before) raw UTF-8 text.
+
+    Structured payloads carry "text" plus optional "voice", "format", "sample_rate",
+    "preset", "deadline" (unix seconds), "stream", "metadata" and "request_id".
+    Text that merely starts with "{" and is not such a JSON object is taken as raw text.
+    """
+    if payload[:1] == b"{":
+        try:
+            request = json.loads(payload)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict) or not isinstance(request.get("text"), str):
+            return {"text": payload.decode('utf-8')}
+    elif _looks_like_msgpack_map(payload):
+        if msgpack is None:
+            raise ValueError("msgpack payload received but msgpack is not installed")
+        request = msgpack.unpackb(payload, raw=False)
+    else:
+        return {"text": payload.decode('utf-8')}
+    if not isinstance(request, dict) or not isinstance(request.get("text"), str):
+        raise ValueError("structured request must be a map with a 'text' string")
+    return request
+
+
+def _looks_like_msgpack_map(payload):
+    if not payload:
+        return False
+    first = payload[0]
+    if 0x80 <= first <= 0x8f:  # fixmap; never the first byte of UTF-8 text
+        return True
+    if first in (0xde, 0xdf):  # map16/map32; also valid UTF-8 lead bytes, so check
+        try:
+            payload.decode('utf-8')
+        except UnicodeDecodeError:
+            return True
+    return False
+
+
+def resample_pcm(samples, orig_rate, new_rate):
+    if orig_rate == new_rate:
+        return samples
+    resampled = torchaudio.functional.resample(torch.from_numpy(samples.astype(np.float32)), orig_rate, new_rate)
+    return torch.clamp(torch.round(resampled), -32768, 32767).numpy().astype(np.int16)
+
+
+def encode_audio(samples, sampling_rate, output_format="wav"):
+    """Encode int16 mono samples in one of OUTPUT_FORMATS"""
+    if output_format == "wav":
+        return encode_wav(samples, sampling_rate)
+    if output_format == "pcm":
+        return np.ascontiguousarray(samples, dtype='<i2').tobytes()
+    buffer = io.BytesIO()
+    subtype = "VORBIS" if output_format == "ogg" else "PCM_16"
+    sf.write(buffer, samples, sampling_rate, format=output_format.upper(), subtype=subtype)
+    return buffer.getvalue()
+
+
+def encode_wav(wav_data, sampling_rate):
+    """Encode int16 PCM samples (as returned by infer_fast) into WAV bytes in memory"""
+    pcm = np.ascontiguousarray(wav_data, dtype=np.int16)
+    channels = pcm.shape[1] if pcm.ndim == 2 else 1
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sampling_rate)
+        wav_file.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+class LRUCache:
+    """Thread-safe LRU mapping bounded by the total size of its values, with hit/miss counters.
+
+    Entries older than ttl seconds (if set) are treated as misses and dropped.
+    """
+
+    def __init__(self, max_bytes, sizeof, ttl=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[2] > self.ttl:
+                del self.entries[key]
+                self.total_bytes -= entry[1]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Insert value, evicting least recently used entries; values larger than the budget are not cached"""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (value, size, time.monotonic())
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class AudioResultCache:
+    """Full-utterance WAV cache: an in-memory LRU tier in front of an optional on-disk
+    tier that survives restarts. Both tiers are bounded in bytes and expire entries
+    after ttl seconds (0 = never)."""
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0, ttl=0):
+        self.memory = LRUCache(memory_bytes, len, ttl=ttl)
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.disk_index = OrderedDict()  # key -> size, least recently used first
+        self.disk_total = 0
+        self.disk_hits = 0
+        self.lookups = 0
+        self.lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    @staticmethod
+    def make_key(text_data, voice_key, params, model_fingerprint):
+        text = " ".join(unicodedata.normalize("NFKC", text_data).split())
+        blob = json.dumps([text, voice_key, params, model_fingerprint], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".wav")
+
+    def _scan_disk(self):
+        """Rebuild the disk index from files left by previous runs, oldest first"""
+        found = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.endswith(".wav"):
+                    stat = os.stat(os.path.join(root, name))
+                    found.append((stat.st_mtime, name[:-len(".wav")], stat.st_size))
+        for _, key, size in sorted(found):
+            self.disk_index[key] = size
+            self.disk_total += size
+        self._evict_disk()
+
+    def _drop_disk(self, key):
+        """Forget a disk entry and delete its file; caller holds the lock"""
+        self.disk_total -= self.disk_index.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass  # another worker sharing the directory may have removed it
+
+    def _evict_disk(self):
+        with self.lock:
+            while self.disk_total > self.disk_bytes and self.disk_index:
+                self._drop_disk(next(iter(self.disk_index)))
+
+    def get(self, key):
+        with self.lock:
+            self.lookups += 1
+        audio_data = self.memory.get(key)
+        if audio_data is not None or not self.disk_dir:
+            return audio_data
+
+        path = self._path(key)
+        with self.lock:
+            if key not in self.disk_index:
+                return None
+            self.disk_index.move_to_end(key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(path) > self.ttl:
+                with self.lock:
+                    self._drop_disk(key)
+                return None
+            with open(path, 'rb') as f:
+                audio_data = f.read()
+        except OSError:
+            with self.lock:
+                self.disk_total -= self.disk_index.pop(key, 0)
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        self.memory.put(key, audio_data)
+        return audio_data
+
+    def put(self, key, audio_data):
+        self.memory.put(key, audio_data)
+        if not self.disk_dir or len(audio_data) > self.disk_bytes:
+            return
+        path = self._path(key)
+        # Write-then-rename so a crash or a concurrent reader never sees a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(audio_data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # Disk full or read-only volume: keep serving from the memory tier
+            logger.warning(f"Could not write result cache entry to {self.disk_dir}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.disk_total += len(audio_data) - self.disk_index.pop(key, 0)
+            self.disk_index[key] = len(audio_data)
+        self._evict_disk()
+
+    def stats(self):
+        memory = self.memory.stats()
+        with self.lock:
+            hits = memory["hits"] + self.disk_hits
+            return {
+                "lookups": self.lookups,
+                "memory_hits": memory["hits"],
+                "disk_hits": self.disk_hits,
+                "misses": self.lookups - hits,
+                "hit_rate": hits / self.lookups if self.lookups else 0.0,
+                "memory_bytes": memory["bytes"],
+                "disk_bytes": self.disk_total,
+                "evictions": memory["evictions"],
+                "expirations": memory["expirations"],
+            }
+
+
+def _conv1d_to_linear(module):
+    """Replace transformers' Conv1D (x @ W + b, W stored in x out) with the equivalent nn.Linear"""
+    from transformers.pytorch_utils import Conv1D
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features, device=child.weight.device)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+
+def tensor_nbytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+
+# Fast-boot snapshot written by bake_snapshot.py and read with INDEX_TTS_SNAPSHOT_DIR
+SNAPSHOT_FORMAT = 1
+
+
+@contextlib.contextmanager
+def timed_phase(timings, phase):
+    """Record how long a startup phase took in timings[phase]"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - start_time
+
+
+def model_file_names(model_dir):
+    """GPT checkpoint, BigVGAN checkpoint and BPE model names as IndexTTS resolves them from config.yaml"""
+    names = ("gpt.pth", "bigvgan_generator.pth", "bpe.model")
+    config_path = os.path.join(model_dir, "config.yaml")
+    if not os.path.exists(config_path):
+        return names
+    cfg = OmegaConf.load(config_path)
+    return (cfg.get("gpt_checkpoint", names[0]), cfg.get("bigvgan_checkpoint", names[1]),
+            cfg.get("dataset", {}).get("bpe_model", names[2]))
+
+
+def missing_model_files(model_dir, snapshot=False):
+    """Paths of every file startup needs that does not exist
+
+    Checkpoint and BPE names come from config.yaml (as IndexTTS resolves them), or the
+    fixed snapshot names, plus any file an INDEX_TTS_* variable explicitly points at.
+    """
+    required = [os.path.join(model_dir, "config.yaml")]
+    names = model_file_names(model_dir)
+    if snapshot:
+        names = ("manifest.json", "gpt.safetensors", "bigvgan.safetensors", names[2])
+    required += [os.path.join(model_dir, name) for name in names]
+    for variable in ('INDEX_TTS_DEFAULT_VOICE', 'INDEX_TTS_PRESETS_FILE', 'INDEX_TTS_WARMUP_TEXTS_FILE'):
+        if os.environ.get(variable):
+            required.append(os.environ[variable])
+    missing = []
+    for file_path in required:
+        if os.path.exists(file_path):
+            logger.debug(f"Found: {file_path}")
+        else:
+            missing.append(file_path)
+    return missing
+
+
+def load_indextts(model_dir, device, timings, parallel=False, snapshot=False):
+    """Load IndexTTS from model_dir, recording the load phases in timings.
+
+    Plain checkpoint loads go through the IndexTTS constructor. Parallel and snapshot
+    loads build the components themselves, see _load_indextts_components.
+    """
+    config_path = os.path.join(model_dir, "config.yaml")
+    with timed_phase(timings, "model_load"):
+        if parallel or snapshot:
+            return _load_indextts_components(model_dir, device, timings, parallel, snapshot)
+        return IndexTTS(
+            cfg_path=config_path,
+            model_dir=model_dir,
+            is_fp16=False,  # reverting back to false
+            device=device,
+            use_cuda_kernel=False  # revert backed to false, got error for deepspeed
+        )
+
+
+def _load_indextts_components(model_dir, device, timings, parallel=False, snapshot=False):
+    """Build an IndexTTS equivalent to IndexTTS(is_fp16=False, use_cuda_kernel=False)
+    from its GPT, BigVGAN and tokenizer, on separate threads when parallel.
+
+    Checkpoints are read with torch.load(mmap=True) and snapshots with safetensors (also
+    memory-mapped), so weights are paged in from the file cache instead of copied up
+    front. Mirrors IndexTTS 1.5's constructor; keep the attributes in sync when
+    upgrading index-tts.
+    """
+    cfg = OmegaConf.load(os.path.join(model_dir, "config.yaml"))
+    gpt_path = os.path.join(model_dir, "gpt.safetensors" if snapshot else cfg.gpt_checkpoint)
+    bigvgan_path = os.path.join(model_dir, "bigvgan.safetensors" if snapshot else cfg.bigvgan_checkpoint)
+    bpe_path = os.path.join(model_dir, cfg.dataset["bpe_model"])
+
+    def load_checkpoint(path):
+        try:
+            return torch.load(path, map_location="cpu", mmap=True)
+        except RuntimeError:
+            # Legacy (non-zipfile) checkpoints cannot be memory-mapped
+            return torch.load(path, map_location="cpu")
+
+    def load_gpt():
+        with timed_phase(timings, "gpt_load"):
+            gpt = UnifiedVoice(**cfg.gpt)
+            if snapshot:
+                state_dict = load_file(gpt_path)
+            else:
+                checkpoint = load_checkpoint(gpt_path)
+                state_dict = checkpoint.get("model", checkpoint)
+            gpt.load_state_dict(state_dict, strict=True)
+            gpt = gpt.to(device)
+            gpt.eval()
+            gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=True, half=False)
+        return gpt
+
+    def load_vocoder():
+        with timed_phase(timings, "vocoder_load"):
+            bigvgan = Generator(cfg.bigvgan, use_cuda_kernel=False)
+            if snapshot:
+                # Snapshots hold the weights with weight norm already folded in
+                bigvgan.remove_weight_norm()
+                bigvgan.load_state_dict(load_file(bigvgan_path), strict=True)
+            else:
+                bigvgan.load_state_dict(load_checkpoint(bigvgan_path)["generator"])
+                bigvgan.remove_weight_norm()
+            bigvgan = bigvgan.to(device)
+            bigvgan.eval()
+        return bigvgan
+
+    def load_tokenizer():
+        with timed_phase(timings, "tokenizer_load"):
+            normalizer = TextNormalizer()
+            normalizer.load()
+            tokenizer = TextTokenizer(bpe_path, normalizer)
+        return normalizer, tokenizer
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3 if parallel else 1, thread_name_prefix="load") as pool:
+        gpt_future = pool.submit(load_gpt)
+        vocoder_future = pool.submit(load_vocoder)
+        tokenizer_future = pool.submit(load_tokenizer)
+        gpt, bigvgan, (normalizer, tokenizer) = (
+            gpt_future.result(), vocoder_future.result(), tokenizer_future.result())
+
+    tts = IndexTTS.__new__(IndexTTS)
+    tts.device = device
+    tts.is_fp16 = False
+    tts.use_cuda_kernel = False
+    tts.cfg = cfg
+    tts.model_dir = model_dir
+    tts.dtype = None
+    tts.stop_mel_token = cfg.gpt.stop_mel_token
+    tts.gpt = gpt
+    tts.gpt_path = gpt_path
+    tts.bigvgan = bigvgan
+    tts.bigvgan_path = bigvgan_path
+    tts.normalizer = normalizer
+    tts.tokenizer = tokenizer
+    tts.bpe_path = bpe_path
+    tts.cache_audio_prompt = None
+    tts.cache_cond_mel = None
+    tts.gr_progress = None
+    tts.model_version = cfg.version if hasattr(cfg, "version") else None
+    return tts
+
+
+def _unshared_state_dict(module, keys=None):
+    """module.state_dict() (only `keys`, if given) as contiguous CPU tensors that share no
+    storage, as safetensors requires"""
+    state_dict = {}
+    storages = set()
+    for name, tensor in module.state_dict().items():
+        if keys is not None and name not in keys:
+            continue
+        tensor = tensor.detach().cpu()
+        if tensor.untyped_storage().data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        state_dict[name] = tensor.contiguous()
+    return state_dict
+
+
+class Histogram:
+    """Thread-safe histogram with fixed bucket upper bounds (inclusive) plus count and sum"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (inf past the last bucket)"""
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + (math.inf,), self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+        return math.inf
+
+    def snapshot(self):
+        """(cumulative count per bucket, count, sum)"""
+        with self.lock:
+            cumulative, total = [], 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+            return cumulative, self.count, self.sum
+
+
+class RollingCost:
+    """Cost records of synthesized requests, aggregated over trailing time windows (seconds)"""
+
+    def __init__(self, windows):
+        self.windows = tuple(sorted(windows))
+        self.records = deque()  # (monotonic time, cost), oldest first
+        self.lock = threading.Lock()
+
+    def _prune(self, now):
+        horizon = now - self.windows[-1]
+        while self.records and self.records[0][0] < horizon:
+            self.records.popleft()
+
+    def add(self, cost):
+        now = time.monotonic()
+        with self.lock:
+            self.records.append((now, cost))
+            self._prune(now)
+
+    def summary(self):
+        """{window: totals of COST_FIELDS plus request count and aggregate RTF (None without audio)}"""
+        now = time.monotonic()
+        with self.lock:
+            self._prune(now)
+            records = list(self.records)
+        summary = {}
+        for window in self.windows:
+            totals = dict.fromkeys(COST_FIELDS, 0)
+            requests = 0
+            for recorded_at, cost in reversed(records):
+                if recorded_at < now - window:
+                    break
+                requests += 1
+                for field in COST_FIELDS:
+                    totals[field] += cost[field]
+            totals["requests"] = requests
+            totals["rtf"] = totals["synthesis_seconds"] / totals["audio_seconds"] if totals["audio_seconds"] else None
+            summary[window] = totals
+        return summary
+
+
+def process_memory_bytes():
+    """Resident set size of this process, from /proc (0 where unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the worker's metrics in the Prometheus text format on GET /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.tts_server.render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape would drown the worker's own logs
+
+
+class PendingReply:
+    """One request in flight: collects its sentence audio and builds reply frames in text order"""
+
+    def __init__(self, envelope, text_data, voice_file, stream=False, silence_samples=0,
+                 output_format="wav", sample_rate=SAMPLING_RATE, preset=None, deadline=None, metadata=False,
+                 request_id=None):
+        self.envelope = envelope
+        self.text_data = text_data
+        self.voice_file = voice_file
+        self.stream = stream
+        self.silence_samples = silence_samples  # inserted before every sentence but the first
+        self.output_format = output_format
+        self.sample_rate = sample_rate
+        self.preset = preset
+        self.deadline = deadline  # unix time after which the client no longer wants the audio
+        self.metadata = metadata  # append the cost record (JSON) to the reply
+        self.request_id = request_id
+        self.received_at = time.perf_counter()
+        self.sentence_count = None  # known once the text is split into sentences
+        self.next_idx = 0
+        self.pending = {}
+        self.wavs = []
+        self.audio = None
+        self.cache_key = None
+        self.cache_hit = False
+        self.error = None
+        self.finished = False
+        self.stage_seconds = {}  # wall time per STAGES entry; a batched stage counts for every request in it
+        self.compute_seconds = 0.0  # this request's share of worker time; a batched stage is split across its requests
+        self.text_tokens = 0
+        self.mel_tokens = 0
+
+    @property
+    def done(self):
+        return self.sentence_count is not None and self.next_idx >= self.sentence_count
+
+    def add(self, idx, wav_data):
+        """Store one sentence's samples and return any stream chunks that are now in order"""
+        self.pending[idx] = wav_data
+        frames = []
+        while self.next_idx in self.pending:
+            wav_data = self.pending.pop(self.next_idx)
+            if self.next_idx > 0 and self.silence_samples:
+                wav_data = np.concatenate([np.zeros(self.silence_samples, dtype=np.int16), wav_data])
+            if self.stream:
+                frames.append(self.envelope + [self.encode(wav_data), STREAM_CHUNK, str(self.next_idx).encode()])
+            self.wavs.append(wav_data)
+            self.next_idx += 1
+        return frames
+
+    def encode(self, samples):
+        """24 kHz int16 samples in the requested sample rate and format"""
+        start_time = time.perf_counter()
+        encoded = encode_audio(resample_pcm(samples, SAMPLING_RATE, self.sample_rate),
+                               self.sample_rate, self.output_format)
+        self.add_stage("encode", time.perf_counter() - start_time)
+        return encoded
+
+    def add_stage(self, stage, seconds, share=1.0):
+        """Add wall time to a stage; `share` is the fraction of it charged to this request's cost"""
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        if stage != "queue_wait":
+            self.compute_seconds += seconds * share
+
+    def stages_ms(self):
+        """Stage breakdown in milliseconds, in pipeline order, for the logs"""
+        return {stage: round(self.stage_seconds[stage] * 1000, 1) for stage in STAGES if stage in self.stage_seconds}
+
+    def audio_data(self):
+        """The whole utterance, encoded as requested"""
+        if self.audio is None:
+            self.audio = self.encode(np.concatenate(self.wavs)) if self.wavs else b""
+        return self.audio
+
+    def cached_frames(self, audio_data):
+        """Reply frames for audio served from the result cache (a stream gets it as a single chunk)"""
+        self.audio = audio_data
+        self.cache_hit = True
+        self._finish()
+        if self.stream:
+            return [self.envelope + [audio_data, STREAM_CHUNK, b"0"],
+                    self.envelope + [self._metadata_frame(), STREAM_END, b"1"]]
+        return [self.envelope + [audio_data] + self._metadata_frames()]
+
+    def final_frames(self):
+        """END/ERROR frame for streams, the full WAV (empty on error) otherwise.
+
+        With metadata requested, the cost record is the END frame's payload, or an extra
+        trailing frame after the WAV.
+        """
+        if self.stream:
+            # The chunks already carried the audio; don't encode the whole utterance again here
+            self._finish()
+            if self.error is not None:
+                return [self.envelope + [str(self.error).encode(), STREAM_ERROR, str(self.next_idx).encode()]]
+            return [self.envelope + [self._metadata_frame(), STREAM_END, str(self.next_idx).encode()]]
+        audio_data = self.audio_data() if self.error is None else b""
+        self._finish()
+        return [self.envelope + [audio_data] + self._metadata_frames()]
+
+    def _metadata_frame(self):
+        return json.dumps(self.cost()).encode() if self.metadata else b""
+
+    def _metadata_frames(self):
+        return [self._metadata_frame()] if self.metadata else []
+
+    def _finish(self):
+        self.finished = True
+        self.stage_seconds["total"] = time.perf_counter() - self.received_at
+
+    @property
+    def audio_seconds(self):
+        """Duration of the synthesized audio, silence included (0 for cache hits and errors)"""
+        return sum(len(wav_data) for wav_data in self.wavs) / SAMPLING_RATE
+
+    def cost(self):
+        """What this request cost: input size, tokens, audio produced, time spent and RTF
+        (synthesis seconds per second of audio). Synthesis seconds are this request's share
+        of worker time, so they add up to the worker's busy time across a batch."""
+        total = self.stage_seconds.get("total", 0.0)
+        synthesis_seconds = self.compute_seconds
+        audio_seconds = self.audio_seconds
+        return {
+            "chars": len(self.text_data),
+            "text_tokens": self.text_tokens,
+            "mel_tokens": self.mel_tokens,
+            "audio_seconds": round(audio_seconds, 3),
+            "wall_seconds": round(total, 3),
+            "synthesis_seconds": round(synthesis_seconds, 3),
+            "rtf": round(synthesis_seconds / audio_seconds, 3) if audio_seconds else None,
+            "cache_hit": self.cache_hit,
+            "request_id": self.request_id,
+        }
+
 
 class IndexTtsServer:
-    def __init__(self, model_size="base"):
+    def __init__(self, model_size="base", tts=None):
         self.service_name = "text-to-wav"  # Keep same service name
+        self.state = None
+        self._set_state(STATE_LOADING)
+
+        # Seconds spent in each startup phase, reported once the worker is ready
+        self.load_timings = OrderedDict([("import", IMPORT_SECONDS)])
+        self._startup_start = time.perf_counter()
 
-        print("Loading IndexTTS model...")
+        logger.info("Loading IndexTTS model...")
         device = "cuda:0" if torch.cuda.is_available() else "cpu"
         device = os.environ.get('DEVICE', device)
-        print(f"IndexTTS device: {device}")
+        logger.info(f"IndexTTS device: {device}")
         
-        # Model directory configuration
-        model_dir = os.environ.get('INDEX_TTS_MODEL_DIR', os.path.join(current_dir, "checkpoints"))
+        # Model directory configuration. INDEX_TTS_SNAPSHOT_DIR boots from a snapshot
+        # written by bake_snapshot.py instead of the .pth checkpoints.
+        self.snapshot_dir = os.environ.get('INDEX_TTS_SNAPSHOT_DIR')
+        model_dir = self.snapshot_dir or os.environ.get('INDEX_TTS_MODEL_DIR', os.path.join(current_dir, "checkpoints"))
+        self.model_dir = model_dir
         config_path = os.path.join(model_dir, "config.yaml")
         
-        print(f"Using model directory: {model_dir}")
-        print(f"Using config path: {config_path}")
-        
-        # Verify model files exist
-        required_files = [
-            "bigvgan_generator.pth",
-            "bpe.model", 
-            "gpt.pth",
-            "config.yaml"
-        ]
-        
-        for file in required_files:
-            file_path = os.path.join(model_dir, file)
-            if not os.path.exists(file_path):
-                print(f"❌ Required file not found: {file_path}")
-                raise FileNotFoundError(f"Missing required model file: {file}")
+        logger.info(f"Using {'snapshot' if self.snapshot_dir else 'model'} directory: {model_dir}")
+        logger.info(f"Using config path: {config_path}")
+        logger.info(f"Offline mode: {OFFLINE}")
+
+        # With INDEX_TTS_PARALLEL_LOAD=1 the GPT, vocoder and tokenizer are built
+        # concurrently from memory-mapped checkpoints
+        self.parallel_load = os.environ.get('INDEX_TTS_PARALLEL_LOAD', '0') == '1'
+        if tts is not None:
+            # Pre-forked worker: the supervisor already loaded the model, shared copy-on-write
+            self.tts = tts
+        else:
+            # Verify every model file exists before loading anything, reporting all missing ones at once
+            with timed_phase(self.load_timings, "file_check"):
+                missing = missing_model_files(model_dir, snapshot=bool(self.snapshot_dir))
+            if missing:
+                for file_path in missing:
+                    logger.error(f"Required file not found: {file_path}")
+                raise FileNotFoundError(f"Missing {len(missing)} required file(s): {', '.join(missing)}")
+
+            # Load IndexTTS model
+            try:
+                self.tts = load_indextts(model_dir, device, self.load_timings,
+                                         parallel=self.parallel_load, snapshot=bool(self.snapshot_dir))
+                logger.info("IndexTTS model loaded successfully!")
+            except Exception as e:
+                logger.exception(f"Failed to initialize IndexTTS: {e}")
+                raise
+        self.snapshot_manifest = None
+        if self.snapshot_dir:
+            with open(os.path.join(model_dir, "manifest.json"), 'r', encoding='utf-8') as f:
+                self.snapshot_manifest = json.load(f)
+            if self.snapshot_manifest.get("format") != SNAPSHOT_FORMAT:
+                raise ValueError(f"Snapshot {model_dir} has format {self.snapshot_manifest.get('format')}, "
+                                 f"expected {SNAPSHOT_FORMAT}; bake it again")
+        self.model_fingerprint = self._model_fingerprint()
+
+        # Opt-in dynamic int8 quantization of the GPT for CPU-only workers
+        self.quantized = False
+        if os.environ.get('INDEX_TTS_QUANTIZE', '0') in ('1', 'int8'):
+            if str(self.tts.device).startswith("cuda"):
+                logger.warning("INDEX_TTS_QUANTIZE only applies to CPU inference, ignoring it on CUDA")
             else:
-                print(f"✅ Found: {file_path}")
+                with timed_phase(self.load_timings, "quantize"):
+                    self._quantize_gpt_int8(
+                        os.environ.get('INDEX_TTS_QUANTIZE_CACHE_DIR', os.path.join(model_dir, "quantized")),
+                        include_conditioning=os.environ.get('INDEX_TTS_QUANTIZE_CONDITIONING', '0') == '1')
 
-        # Load IndexTTS model
-        try:
-            self.tts = IndexTTS(
-                cfg_path=config_path,
-                model_dir=model_dir,
-                is_fp16=False,  # reverting back to false
-                device=device,
-                use_cuda_kernel=False  # revert backed to false, got error for deepspeed
-            )
-            print("IndexTTS model loaded successfully!")
-        except Exception as e:
-            print(f"❌ Failed to initialize IndexTTS: {e}")
-            raise
+        # Opt-in torch.compile of the GPT decoder step and the BigVGAN vocoder. Compiled
+        # graphs are cached in INDEX_TTS_COMPILE_CACHE_DIR and reused across restarts.
+        self.compiled = False
+        if os.environ.get('INDEX_TTS_COMPILE', '0') == '1':
+            with timed_phase(self.load_timings, "compile"):
+                self._compile_models(
+                    os.environ.get('INDEX_TTS_COMPILE_CACHE_DIR', os.path.join(model_dir, "compile_cache")),
+                    os.environ.get('INDEX_TTS_COMPILE_MODE', 'default'))
 
         # Default voice file - can be overridden per request
         self.default_voice = os.environ.get('INDEX_TTS_DEFAULT_VOICE', 
                                           os.path.join(current_dir, "coXTTS.wav"))
         
         if os.path.exists(self.default_voice):
-            print(f"✅ Default voice file found: {self.default_voice}")
+            logger.info(f"Default voice file found: {self.default_voice}")
+        else:
+            logger.warning(f"Default voice file not found: {self.default_voice}; "
+                           "voice file will need to be provided in each request")
+
+        # Speaker conditioning (reference mel) per voice, keyed by a hash of the audio content
+        speaker_cache_mb = float(os.environ.get('INDEX_TTS_SPEAKER_CACHE_MB', '64'))
+        self.speaker_cache = LRUCache(int(speaker_cache_mb * 1024 * 1024), tensor_nbytes)
+        self._voice_hashes = {}
+        if os.path.exists(self.default_voice):
+            with timed_phase(self.load_timings, "voice_conditioning"), torch.inference_mode():
+                if not self._load_snapshot_conditioning():
+                    self._get_conditioning(self.default_voice)
+            logger.info(f"Default voice conditioning cached ({self.voice_hash(self.default_voice)[:12]})")
+
+        # Full-utterance result cache. Only deterministic (do_sample=False) output is cached,
+        # keyed by normalized text, voice hash, inference parameters and model fingerprint.
+        result_cache_mb = float(os.environ.get('INDEX_TTS_RESULT_CACHE_MB', '256'))
+        if result_cache_mb > 0:
+            self.result_cache = AudioResultCache(
+                int(result_cache_mb * 1024 * 1024),
+                disk_dir=os.environ.get('INDEX_TTS_RESULT_CACHE_DIR') or None,
+                disk_bytes=int(float(os.environ.get('INDEX_TTS_RESULT_CACHE_DISK_MB', '2048')) * 1024 * 1024),
+                ttl=float(os.environ.get('INDEX_TTS_RESULT_CACHE_TTL_S', '0')))
+            logger.info(f"Result cache: {result_cache_mb:g} MB in memory, disk tier: "
+                        f"{self.result_cache.disk_dir or 'off'} ({len(self.result_cache.disk_index)} entries)")
         else:
-            print(f"⚠️  Default voice file not found: {self.default_voice}")
-            print("Voice file will need to be provided in each request")
+            self.result_cache = None
+
+        # Inference presets: the worker default applies unless a request names another one
+        self.presets = load_presets(os.environ.get('INDEX_TTS_PRESETS_FILE'))
+        self.default_preset = os.environ.get('INDEX_TTS_PRESET', 'balanced')
+        if self.default_preset not in self.presets:
+            raise ValueError(f"Unknown INDEX_TTS_PRESET {self.default_preset!r}, "
+                             f"available: {', '.join(sorted(self.presets))}")
+        logger.info(f"Default preset: {self.default_preset} (available: {', '.join(sorted(self.presets))})")
+
+        # Resolve every preset's precision for this device once, so cache keys reflect what actually runs
+        worker_precision = os.environ.get('INDEX_TTS_PRECISION', 'auto')
+        if worker_precision not in PRECISIONS:
+            raise ValueError(f"Invalid INDEX_TTS_PRECISION {worker_precision!r}, expected one of {PRECISIONS}")
+        self.autocast_device = "cuda" if str(self.tts.device).startswith("cuda") else "cpu"
+        for name, params in self.presets.items():
+            # Dynamically quantized linears take FP32 activations only
+            params["precision"] = "fp32" if self.quantized else resolve_precision(
+                params["precision"], str(self.tts.device), worker_precision)
+        if self.autocast_device == "cpu":
+            logger.info(f"CPU native bf16 support: {cpu_supports_bf16()}")
+        logger.info("Preset precision: " + ", ".join(
+            f"{name}={params['precision']}" for name, params in sorted(self.presets.items())))
+
+        # Adaptive decode budget: each bucket's max_mel_tokens is derived from its longest
+        # sentence (text tokens x calibrated mel tokens per text token, plus a safety margin
+        # and a floor), never above the preset's max_mel_tokens. Sentences that still end
+        # without a stop token are counted as truncated.
+        self.adaptive_mel_tokens = os.environ.get('INDEX_TTS_ADAPTIVE_MEL_TOKENS', '1') == '1'
+        self.mel_tokens_per_text_token = float(os.environ.get('INDEX_TTS_MEL_TOKENS_PER_TEXT_TOKEN', '8.0'))
+        self.mel_token_margin = float(os.environ.get('INDEX_TTS_MEL_TOKEN_MARGIN', '0.5'))
+        self.min_mel_tokens = int(os.environ.get('INDEX_TTS_MIN_MEL_TOKENS', '50'))
+        # The cap can truncate audio, so it is part of every result and sentence cache key
+        self.mel_token_settings = {"adaptive_mel_tokens": self.adaptive_mel_tokens}
+        if self.adaptive_mel_tokens:
+            self.mel_token_settings.update(mel_tokens_per_text_token=self.mel_tokens_per_text_token,
+                                           mel_token_margin=self.mel_token_margin,
+                                           min_mel_tokens=self.min_mel_tokens)
+        self.sentences_generated = 0
+        self.sentences_truncated = 0
+
+        # Voices selectable per request by id: <INDEX_TTS_VOICE_DIR>/<id>.wav
+        self.voice_dir = os.environ.get('INDEX_TTS_VOICE_DIR')
+
+        # Per-sentence audio cache shared by all requests, so responses that differ overall
+        # still reuse common sentences (greetings, disclaimers, closings)
+        sentence_cache_mb = float(os.environ.get('INDEX_TTS_SENTENCE_CACHE_MB', '128'))
+        self.sentence_cache = (LRUCache(int(sentence_cache_mb * 1024 * 1024), lambda wav: wav.nbytes)
+                               if sentence_cache_mb > 0 else None)
+        # Silence between sentences, applied the same way to cached and fresh segments
+        self.sentence_silence_samples = int(
+            float(os.environ.get('INDEX_TTS_SENTENCE_SILENCE_MS', '0')) * SAMPLING_RATE / 1000)
+
+        # Opt-in debug mode: write every response WAV under this directory and keep it
+        self.debug_wav_dir = os.environ.get('INDEX_TTS_DEBUG_WAV_DIR')
+        if self.debug_wav_dir:
+            os.makedirs(self.debug_wav_dir, exist_ok=True)
+            logger.info(f"Debug mode: response WAV files kept in {self.debug_wav_dir}")
+
+        # Reply mode default; a request can also ask for streaming with a trailing b"stream" frame
+        self.streaming = os.environ.get('INDEX_TTS_STREAMING', '0') == '1'
+        logger.info(f"Streaming replies by default: {self.streaming}")
+
+        # Micro-batching: after a request arrives, wait up to the window for more
+        # (at most batch_max_requests) and synthesize them in one pass.
+        # A 0 ms window only picks up requests that are already queued.
+        self.batch_max_requests = max(1, int(os.environ.get('INDEX_TTS_BATCH_MAX_REQUESTS', '8')))
+        self.batch_window_ms = float(os.environ.get('INDEX_TTS_BATCH_WINDOW_MS', '0'))
+        logger.info(f"Micro-batching: up to {self.batch_max_requests} requests within {self.batch_window_ms:g} ms")
+
+        # Decoded requests waiting for the inference thread. When it is full the I/O
+        # thread stops reading from the broker so the backlog stays with the broker.
+        self.requests = queue.Queue(maxsize=max(1, int(os.environ.get('INDEX_TTS_QUEUE_SIZE', '16'))))
+
+        # Per-stage latency histograms (see STAGES); p50/p99 are logged every N requests
+        self.stage_latency = {stage: Histogram(LATENCY_BUCKETS) for stage in STAGES}
+        self.mel_token_counts = Histogram(MEL_TOKEN_BUCKETS)
+        self.latency_report_every = int(os.environ.get('INDEX_TTS_LATENCY_REPORT_EVERY', '100'))
+        self.requests_observed = 0
+        self._normalize_seconds = 0.0
+
+        # Prometheus metrics over HTTP (0 = off); supervised workers listen on port + worker id
+        self.metrics_port = int(os.environ.get('INDEX_TTS_METRICS_PORT', '0'))
+        if self.metrics_port:
+            self.metrics_port += int(os.environ.get('INDEX_TTS_WORKER_ID', '0'))
+        self.metrics_lock = threading.Lock()
+        self.request_counts = {"ok": 0, "cache_hit": 0, "error": 0}
+        self.error_counts = {"synthesis": 0, "deadline": 0, "invalid_request": 0, "draining": 0}
+        self.rtf = Histogram(RTF_BUCKETS)
+        self.audio_seconds_total = 0.0
+
+        # Cost accounting: synthesized requests' cost records summed over rolling windows,
+        # logged with the latency summary and exported as metrics
+        self.cost_windows = RollingCost(
+            float(window) for window in os.environ.get('INDEX_TTS_COST_WINDOWS_S', '60,300,900').split(','))
+        self._instrument_normalizer()
+
+        # Warm-up grid: INDEX_TTS_WARMUP_TEXTS_FILE holds one text per line
+        warmup_texts_file = os.environ.get('INDEX_TTS_WARMUP_TEXTS_FILE')
+        if warmup_texts_file:
+            with open(warmup_texts_file, 'r', encoding='utf-8') as f:
+                self.warmup_texts = [line.strip() for line in f if line.strip()]
+        else:
+            self.warmup_texts = WARMUP_TEXTS
+        self.warmup_batch_sizes = tuple(
+            int(size) for size in os.environ.get('INDEX_TTS_WARMUP_BATCH_SIZES', '1,2,4').split(','))
+        self.warmup_budget = float(os.environ.get('INDEX_TTS_WARMUP_BUDGET_S', '180'))
+
+        # On SIGTERM: stop taking work, finish what is queued, exit within this many seconds
+        self.drain_timeout = float(os.environ.get('INDEX_TTS_DRAIN_TIMEOUT_S', '30'))
+
+        # Warm up models to avoid first-request delays. Nothing is connected to the
+        # broker yet, so no traffic can reach a worker that is still warming up.
+        self._set_state(STATE_WARMING)
+        with timed_phase(self.load_timings, "warm_up"):
+            warmed_up = self.warm_up_models()
+        if not warmed_up:
+            self._set_state(STATE_FAILED)
+            raise RuntimeError("IndexTTS warm-up failed; worker not registered with the broker")
+        self._report_startup(device)
+
+        # Broker liveness. ZMTP heartbeats (transport level) detect a dead connection and
+        # every reconnect re-sends the registration, which covers broker restarts without
+        # broker support. Application heartbeats are opt-in: every interval the worker sends
+        # [service name, HEARTBEAT], and after `liveness` silent intervals it rebuilds the socket.
+        self.transport_heartbeat_ms = int(os.environ.get('ZMQ_TRANSPORT_HEARTBEAT_MS', '5000'))
+        self.heartbeat_interval = float(os.environ.get('ZMQ_HEARTBEAT_INTERVAL_S', '0'))
+        self.heartbeat_liveness = int(os.environ.get('ZMQ_HEARTBEAT_LIVENESS', '3'))
+        self.reconnect_backoff = self.MIN_RECONNECT_BACKOFF
 
         # ZMQ setup - keep same architecture
         self.url = os.environ.get('ZMQ_BACKEND_ROUTER_URL', 'tcp://localhost:5560')
         self.context = zmq.Context()
+        self._connect()
+        # Only the I/O thread touches self.socket; the inference thread hands it replies over this pipe
+        self.reply_receiver = self.context.socket(zmq.PAIR)
+        self.reply_receiver.bind(REPLY_PIPE_URL)
+
+        # Opt-in admin REP socket, polled by the I/O thread; "{worker}" in the URL is replaced
+        # by the worker id. It can arm torch.profiler for the next N requests (at most
+        # INDEX_TTS_PROFILE_MAX_REQUESTS); traces and summaries go to INDEX_TTS_PROFILE_DIR.
+        self.profile_dir = os.environ.get('INDEX_TTS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), "tts_profiles"))
+        self.profile_max_requests = int(os.environ.get('INDEX_TTS_PROFILE_MAX_REQUESTS', '20'))
+        self.profile_remaining = 0
+        self.profiles_written = 0
+        self.profile_lock = threading.Lock()
+        self.admin_socket = None
+        admin_url = os.environ.get('INDEX_TTS_ADMIN_URL')
+        if admin_url:
+            admin_url = admin_url.format(worker=os.environ.get('INDEX_TTS_WORKER_ID', '0'))
+            self.admin_socket = self.context.socket(zmq.REP)
+            self.admin_socket.bind(admin_url)
+            logger.info(f"Admin socket: {admin_url}")
+
+    MIN_RECONNECT_BACKOFF = 1.0
+    MAX_RECONNECT_BACKOFF = 32.0
+
+    def _connect(self):
         self.socket = self.context.socket(zmq.DEALER)
+        if self.transport_heartbeat_ms > 0:
+            self.socket.setsockopt(zmq.HEARTBEAT_IVL, self.transport_heartbeat_ms)
+            self.socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 3 * self.transport_heartbeat_ms)
         self.socket.connect(self.url)
+        self.monitor = self.socket.get_monitor_socket(zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED)
+        self.connected_once = False
+
+    def _reconnect(self):
+        """Replace the DEALER with a fresh one and register again"""
+        self.socket.disable_monitor()
+        self.monitor.close(linger=0)
+        self.socket.close(linger=0)
+        self._connect()
+        self.register()
 
-        # Register with broker - same service name
+    def _set_state(self, state):
+        logger.info(f"Worker state: {self.state} -> {state}", extra={"fields": {"state": state}})
+        self.state = state
+
+    def register(self):
+        """Register with broker - same service name"""
         self.socket.send_multipart([self.service_name.encode()])
 
-        # Warm up models to avoid first-request delays
-        self.warm_up_models()
+    def _report_startup(self, device):
+        """Log the startup phase timings as one JSON line, and write them to INDEX_TTS_STARTUP_REPORT if set.
 
-    def warm_up_models(self):
-        """Warm up IndexTTS model with dummy text to avoid first-request delays"""
-        print("Warming up IndexTTS model...")
-        dummy_text = "测试"  # Simple Chinese text
-        
-        # Create temp file for dummy output
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=True) as temp_file:
-            try:
-                # Use default voice if available, otherwise skip warmup
-                if os.path.exists(self.default_voice):
-                    self.process_text(dummy_text, temp_file.name, self.default_voice)
-                    print("IndexTTS model warmed up successfully!")
-                else:
-                    print("Skipping warmup - no default voice file available")
-            except Exception as e:
-                print(f"Warning: Failed to warm up models: {e}")
+        Parallel and snapshot loads also report the component phases (gpt_load, vocoder_load,
+        tokenizer_load); in parallel they overlap, so they add up to more than model_load.
+        """
+        report = {
+            "event": "startup",
+            "device": device,
+            "parallel_load": self.parallel_load,
+            "snapshot": bool(self.snapshot_dir),
+            "phases": {phase: round(seconds, 3) for phase, seconds in self.load_timings.items()},
+            "total_s": round(IMPORT_SECONDS + time.perf_counter() - self._startup_start, 3),
+        }
+        logger.info("Startup report", extra={"fields": report})
+        report_path = os.environ.get('INDEX_TTS_STARTUP_REPORT')
+        if report_path:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
 
-    def process_text(self, text_data, output_file, voice_file=None):
-        print("Received text data for synthesis:")
-        print("→", text_data)
-        print("Saving audio to:", output_file)
-        
-        if voice_file:
-            print("Using voice file:", voice_file)
+    def _model_fingerprint(self):
+        """Identifies the loaded weights for cache keys: config content plus checkpoint sizes and mtimes
+        (hashing multi-GB checkpoints on every boot would cost more than it saves).
+        A snapshot keeps the fingerprint of the checkpoints it was baked from."""
+        if self.snapshot_manifest is not None:
+            return self.snapshot_manifest["model_fingerprint"]
+        digest = hashlib.sha256()
+        with open(os.path.join(self.model_dir, "config.yaml"), 'rb') as f:
+            digest.update(f.read())
+        for name in model_file_names(self.model_dir):
+            stat = os.stat(os.path.join(self.model_dir, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    def bake_snapshot(self, snapshot_dir):
+        """Write the loaded model to snapshot_dir for INDEX_TTS_SNAPSHOT_DIR boots.
+
+        The snapshot holds the GPT and BigVGAN weights as safetensors (BigVGAN with weight
+        norm removed), config.yaml and the BPE model, the default voice conditioning and a
+        manifest. The manifest is written last, so an interrupted bake is not bootable.
+        """
+        if self.quantized or self.compiled:
+            raise RuntimeError("Bake snapshots from an eager FP32 worker (INDEX_TTS_QUANTIZE=0, INDEX_TTS_COMPILE=0)")
+        if os.path.abspath(snapshot_dir) == os.path.abspath(self.model_dir):
+            raise ValueError(f"Cannot bake a snapshot into the directory it was loaded from: {snapshot_dir}")
+        start_time = time.perf_counter()
+        os.makedirs(snapshot_dir, exist_ok=True)
+        manifest_path = os.path.join(snapshot_dir, "manifest.json")
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        # post_init_gpt2_config adds aliases of the GPT weights (inference_model.*, gpt.wte)
+        # that it rebuilds at boot, so keep only the keys of a freshly built UnifiedVoice
+        with torch.device("meta"):
+            gpt_keys = set(UnifiedVoice(**self.tts.cfg.gpt).state_dict())
+        save_file(_unshared_state_dict(self.tts.gpt, keys=gpt_keys),
+                  os.path.join(snapshot_dir, "gpt.safetensors"))
+        save_file(_unshared_state_dict(self.tts.bigvgan), os.path.join(snapshot_dir, "bigvgan.safetensors"))
+        shutil.copy2(os.path.join(self.model_dir, "config.yaml"), os.path.join(snapshot_dir, "config.yaml"))
+        bpe_path = os.path.join(snapshot_dir, self.tts.cfg.dataset["bpe_model"])
+        os.makedirs(os.path.dirname(bpe_path), exist_ok=True)
+        shutil.copy2(self.tts.bpe_path, bpe_path)
+
+        voice_hash = None
+        if os.path.exists(self.default_voice):
+            voice_hash = self.voice_hash(self.default_voice)
+            with torch.inference_mode():
+                cond_mel = self._get_conditioning(self.default_voice)
+            save_file({"cond_mel": cond_mel.detach().cpu().contiguous()}, os.path.join(snapshot_dir, "voice.safetensors"))
+
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "model_fingerprint": self.model_fingerprint,
+            "source_model_dir": os.path.abspath(self.model_dir),
+            "default_voice_hash": voice_hash,
+            "torch_version": torch.__version__,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        logger.info(f"Snapshot baked to {snapshot_dir} in {time.perf_counter() - start_time:.1f}s")
+
+    def _load_snapshot_conditioning(self):
+        """Seed the speaker cache with the snapshot's default voice conditioning, if it
+        was baked from the same audio; returns whether it did"""
+        if self.snapshot_manifest is None:
+            return False
+        voice_path = os.path.join(self.model_dir, "voice.safetensors")
+        voice_hash = self.voice_hash(self.default_voice)
+        if self.snapshot_manifest.get("default_voice_hash") != voice_hash or not os.path.exists(voice_path):
+            return False
+        self.speaker_cache.put(voice_hash, load_file(voice_path)["cond_mel"].to(self.tts.device))
+        return True
+
+    def _quantize_gpt_int8(self, cache_dir, include_conditioning=False):
+        """Swap the GPT's linear layers for dynamically quantized int8 ones.
+
+        The quantized module is pickled under cache_dir, keyed by the model fingerprint,
+        so later boots load it instead of quantizing again.
+        """
+        key = hashlib.sha256(
+            f"{self.model_fingerprint}:{include_conditioning}:{torch.__version__}".encode()).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, f"gpt_int8_{key}.pt")
+        start_time = time.perf_counter()
+        if os.path.exists(cache_path):
+            self.tts.gpt = torch.load(cache_path, map_location="cpu", weights_only=False)
+            logger.info(f"Loaded int8 GPT from {cache_path} in {time.perf_counter() - start_time:.1f}s")
         else:
-            voice_file = self.default_voice
-            print("Using default voice file:", voice_file)
+            gpt = self.tts.gpt
+            # HF GPT-2 blocks use transformers' Conv1D, which quantize_dynamic does not know
+            _conv1d_to_linear(gpt.gpt)
+            qconfig = torch.ao.quantization.default_dynamic_qconfig
+            # inference_model shares the transformer with gpt.gpt but wraps mel_head in its own lm_head
+            spec = {"gpt": qconfig, "mel_head": qconfig, "inference_model": qconfig}
+            if include_conditioning:
+                spec.update({"conditioning_encoder": qconfig, "perceiver_encoder": qconfig})
+            torch.ao.quantization.quantize_dynamic(gpt, spec, dtype=torch.qint8, inplace=True)
+            logger.info(f"Quantized GPT to int8 in {time.perf_counter() - start_time:.1f}s")
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                torch.save(gpt, tmp_path)
+                os.replace(tmp_path, cache_path)
+                logger.info(f"Saved int8 GPT to {cache_path}")
+            except OSError as e:
+                logger.warning(f"Could not cache int8 GPT in {cache_dir}: {e}")
+        self.quantized = True
+        # int8 output differs from FP32, so result and sentence cache entries must not be shared
+        self.model_fingerprint = hashlib.sha256(
+            f"{self.model_fingerprint}:int8:{include_conditioning}".encode()).hexdigest()
+
+    def _compile_models(self, cache_dir, mode):
+        """torch.compile the decoder step HF generate() calls per token and BigVGAN.
+
+        Any failure leaves the models eager, as with DeepSpeed before. Shapes are compiled
+        dynamically and warmed up over the grid in warm_up_models, so live traffic does not
+        trigger recompiles; if one fails anyway dynamo falls back to eager for that call.
+        """
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        self._eager_bigvgan = self.tts.bigvgan
+        try:
+            import torch._dynamo
+            torch._dynamo.config.suppress_errors = True
+            # Every bucket size and dynamic-shape specialization counts against this limit
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+            inference_model = self.tts.gpt.inference_model
+            inference_model.forward = torch.compile(inference_model.forward, dynamic=True, mode=mode)
+            self.tts.bigvgan = torch.compile(self.tts.bigvgan, dynamic=True, mode=mode)
+            self.compiled = True
+            logger.info(f"torch.compile enabled (mode={mode}, cache={os.environ['TORCHINDUCTOR_CACHE_DIR']})")
+        except Exception as e:
+            logger.warning(f"torch.compile unavailable, running eager: {e}")
+            self._restore_eager()
+
+    def _restore_eager(self):
+        # The compiled forward is an instance attribute shadowing the class method
+        self.tts.gpt.inference_model.__dict__.pop("forward", None)
+        self.tts.bigvgan = self._eager_bigvgan
+        self.compiled = False
+
+    def warm_up_models(self):
+        """Warm up IndexTTS over a grid of texts x batch sizes to avoid first-request delays.
+
+        Stops early once the warm-up budget is spent. Returns False if synthesis failed,
+        so the worker is never registered.
+        """
+        logger.info("Warming up IndexTTS model...")
+
+        # Use default voice if available, otherwise skip warmup
+        if not os.path.exists(self.default_voice):
+            logger.warning("Skipping warmup - no default voice file available")
+            return True
+
+        # infer_fast does not batch on CPU either
+        batch_sizes = self.warmup_batch_sizes if self.autocast_device == "cuda" else (1,)
+        grid = [(text_data, batch_size) for text_data in self.warmup_texts for batch_size in batch_sizes]
+        start_time = time.perf_counter()
+        for i, (text_data, batch_size) in enumerate(grid, 1):
+            elapsed = time.perf_counter() - start_time
+            if i > 1 and elapsed > self.warmup_budget:
+                logger.warning(f"Warm-up budget of {self.warmup_budget:g}s spent, "
+                               f"skipping {len(grid) - i + 1} remaining shapes")
+                break
+            shape_start = time.perf_counter()
+            error = self._warm_up_shape(text_data, batch_size)
+            if error is not None and self.compiled:
+                logger.warning(f"Compiled models failed during warm-up, falling back to eager: {error}")
+                self._restore_eager()
+                error = self._warm_up_shape(text_data, batch_size)
+            if error is not None:
+                logger.error(f"Failed to warm up models: {error}")
+                return False
+            label = text_data if len(text_data) <= 20 else text_data[:19] + "…"
+            logger.info(f"warm-up [{i}/{len(grid)}] {label!r} ({len(text_data)} chars) x {batch_size}: "
+                        f"{time.perf_counter() - shape_start:.2f}s")
+        logger.info(f"IndexTTS model warmed up successfully in {time.perf_counter() - start_time:.1f}s!")
+        return True
+
+    def _warm_up_shape(self, text_data, batch_size):
+        """Synthesize text_data batch_size times in one batch; returns the error, if any"""
+        replies = [PendingReply([], text_data, self.default_voice) for _ in range(batch_size)]
+        for _ in self.synthesize_batch(replies, use_cache=False):
+            pass
+        for reply in replies:
+            if reply.error is not None:
+                return reply.error
+            if not reply.wavs:
+                return RuntimeError("no audio generated")
+        return None
+
+    def process_text(self, text_data, output_file=None, voice_file=None, use_cache=True, preset=None):
+        """Synthesize text and return (status message, WAV bytes).
+
+        The waveform is encoded to WAV in memory; output_file (debug mode) also writes it to disk.
+        """
+        voice_file = voice_file or self.default_voice
+        logger.debug("Received text data for synthesis",
+                     extra={"fields": dict(text_fields(text_data), voice=voice_file, output_file=output_file)})
 
         try:
-            # Ensure output directory exists
-            os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            
             # Use IndexTTS inference
             start_time = time.perf_counter()
-            
-            # Previous behavior:
-            #   We called infer_fast directly in full FP32. Turning on is_fp16/use_cuda_kernel
-            #   in this repo pulled in DeepSpeed and attempted to compile CUDA ops, which
-            #   fails in our production image (no CUDA toolkit/CUDA_HOME).
-            # Change:
-            #   Use PyTorch AMP (FP16 autocast) + inference_mode to get T4 speedups without
-            #   requiring DeepSpeed or a full CUDA toolchain. Ops that lack FP16 support
-            #   fall back to FP32 automatically inside autocast.
-            with torch.inference_mode():
-                # Use the new torch.amp.autocast API (torch>=2.0). The old torch.cuda.amp.autocast is deprecated.
-                with torch.amp.autocast("cuda", dtype=torch.float16):
-                    self.tts.infer_fast(
-                        audio_prompt=voice_file,
-                        text=text_data,
-                        output_path=output_file,
-                        verbose=False,
-                        max_text_tokens_per_sentence=100,
-                        sentences_bucket_max_size=4,
-                        do_sample=False,  # for production T4 GPU
-                        top_p=0.8,
-                        top_k=30,
-                        temperature=1.0,
-                        length_penalty=0.0,
-                        num_beams=1, # original num_beams is 3
-                        repetition_penalty=10.0,
-                        max_mel_tokens=600
-                    )
-            
+            reply = PendingReply([], text_data, voice_file, silence_samples=self.sentence_silence_samples,
+                                 preset=preset)
+            for _ in self.synthesize_batch([reply], use_cache=use_cache):
+                pass
+            if reply.error is not None:
+                raise reply.error
+            audio_data = reply.audio_data()
+
             inference_time = time.perf_counter() - start_time
-            print(f"✅ IndexTTS inference completed in {inference_time:.2f} seconds")
 
-            if not os.path.exists(output_file):
-                print("❌ Audio file was not created!")
-                return "Error: IndexTTS failed to generate audio."
-            else:
-                file_size = os.path.getsize(output_file)
-                print(f"✅ Audio file created successfully. Size: {file_size} bytes")
-                return "Text processed successfully!"
+            if not audio_data:
+                logger.error("No audio was generated!")
+                return "Error: IndexTTS failed to generate audio.", b""
+            if output_file:
+                self._write_debug_wav(output_file, audio_data)
+            logger.info(f"IndexTTS inference completed in {inference_time:.2f} seconds", extra={
+                "sampled": True,
+                "fields": {"bytes": len(audio_data), "stages_ms": reply.stages_ms(), "cost": reply.cost()}})
+            return "Text processed successfully!", audio_data
                 
         except Exception as e:
-            print(f"❌ Exception during IndexTTS processing: {e}")
-            return f"Error in text processing: {str(e)}"
+            logger.error(f"Exception during IndexTTS processing: {e}")
+            return f"Error in text processing: {str(e)}", b""
 
-    def run(self):
-        while True:
+    @contextlib.contextmanager
+    def _inference_context(self, precision):
+        # Previous behavior:
+        #   We called infer_fast directly in full FP32. Turning on is_fp16/use_cuda_kernel
+        #   in this repo pulled in DeepSpeed and attempted to compile CUDA ops, which
+        #   fails in our production image (no CUDA toolkit/CUDA_HOME).
+        # Change:
+        #   Use PyTorch AMP (FP16 autocast on CUDA, bf16 on capable CPUs) + inference_mode
+        #   to get speedups without requiring DeepSpeed or a full CUDA toolchain. Ops that
+        #   lack low-precision support fall back to FP32 automatically inside autocast.
+        dtype = AUTOCAST_DTYPES[precision]
+        with torch.inference_mode():
+            # Use the new torch.amp.autocast API (torch>=2.0). The old torch.cuda.amp.autocast is deprecated.
+            with torch.amp.autocast(self.autocast_device, dtype=dtype, enabled=dtype is not None):
+                yield
+
+    def voice_hash(self, voice_file):
+        """SHA-256 of the reference audio, memoized per (path, mtime, size)"""
+        stat = os.stat(voice_file)
+        memo_key = (voice_file, stat.st_mtime_ns, stat.st_size)
+        digest = self._voice_hashes.get(memo_key)
+        if digest is None:
+            with open(voice_file, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            self._voice_hashes[memo_key] = digest
+        return digest
+
+    def _instrument_normalizer(self):
+        """Time TextNormalizer.normalize, which TextTokenizer.tokenize calls internally,
+        so normalization and tokenization can be reported as separate stages"""
+        normalizer = self.tts.normalizer
+        normalize = normalizer.normalize
+
+        def timed_normalize(text):
+            start_time = time.perf_counter()
             try:
-                print("IndexTTS server is ready to receive a message ...")
-                message = self.socket.recv_multipart()
-                payload = message[3]
-
-                temp_dir = tempfile.mkdtemp()
-                temp_audio_path = os.path.join(temp_dir, "response.wav")
-
-                # For now, use default voice file
-                # In a more advanced implementation, you could parse the payload
-                # to extract voice file information if needed
-                status_msg = self.process_text(payload.decode('utf-8'), temp_audio_path)
-                print("Status:", status_msg)
-                # add more logs and test
-                if os.path.exists(temp_audio_path):
-                    with open(temp_audio_path, 'rb') as audio_file:
-                        audio_data = audio_file.read()
+                return normalize(text)
+            finally:
+                self._normalize_seconds += time.perf_counter() - start_time
+
+        normalizer.normalize = timed_normalize
+
+    @contextlib.contextmanager
+    def _timed_stage(self, stage, replies, weights=None):
+        """Add the block's wall time to stage `stage` of every reply it served
+        (and label it tts::<stage> in profiler traces). For cost, the time is split
+        across the replies in proportion to `weights` (evenly by default)."""
+        start_time = time.perf_counter()
+        with torch.profiler.record_function(f"tts::{stage}"):
+            yield
+            if self.autocast_device == "cuda":
+                # Charge queued kernels to the stage that launched them
+                torch.cuda.synchronize(self.tts.device)
+        elapsed = time.perf_counter() - start_time
+        weights = weights or [1] * len(replies)
+        for reply, weight in zip(replies, weights):
+            reply.add_stage(stage, elapsed, share=weight / sum(weights))
+
+    @contextlib.contextmanager
+    def _profiled(self, replies):
+        """Run the block under torch.profiler while profiling is armed, then write its
+        Chrome trace and a key_averages summary table to the profile directory"""
+        with self.profile_lock:
+            armed = self.profile_remaining > 0
+            if armed:
+                self.profile_remaining = max(0, self.profile_remaining - len(replies))
+        if not armed:
+            yield
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.autocast_device == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+            yield
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.profiles_written += 1
+            name = f"tts-{time.strftime('%Y%m%d-%H%M%S')}-pid{os.getpid()}-{self.profiles_written}"
+            trace_path = os.path.join(self.profile_dir, name + ".json")
+            profiler.export_chrome_trace(trace_path)
+            sort_by = "self_cuda_time_total" if self.autocast_device == "cuda" else "self_cpu_time_total"
+            with open(os.path.join(self.profile_dir, name + ".txt"), 'w', encoding='utf-8') as f:
+                f.write(f"requests: {', '.join(str(reply.request_id) for reply in replies)}\n")
+                f.write(f"stages_ms: {json.dumps([reply.stages_ms() for reply in replies])}\n\n")
+                f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+            logger.info(f"Profile of {len(replies)} requests written to {trace_path}")
+        except Exception as e:
+            logger.warning(f"Could not write profile to {self.profile_dir}: {e}")
+
+    def _handle_admin(self):
+        """Answer one admin request (JSON): {"command": "profile", "requests": N} arms the
+        profiler for the next N requests; {"command": "status"} reports worker state"""
+        try:
+            request = json.loads(self.admin_socket.recv())
+            command = request.get("command")
+            if command == "profile":
+                count = min(max(1, int(request.get("requests", 1))), self.profile_max_requests)
+                with self.profile_lock:
+                    self.profile_remaining = count
+                logger.info(f"Profiler armed for the next {count} requests")
+                response = {"ok": True, "armed_requests": count, "profile_dir": self.profile_dir}
+            elif command == "status":
+                with self.profile_lock:
+                    profile_remaining = self.profile_remaining
+                response = {"ok": True, "state": self.state, "queue_depth": self.requests.qsize(),
+                            "requests_observed": self.requests_observed, "profile_remaining": profile_remaining}
+            else:
+                raise ValueError(f"unknown command {command!r}")
+        except Exception as e:
+            response = {"ok": False, "error": str(e)}
+        self.admin_socket.send_string(json.dumps(response))
+
+    def _record_metrics(self, reply):
+        """Add a finished request to the counters and histograms"""
+        for stage, seconds in reply.stage_seconds.items():
+            self.stage_latency[stage].observe(seconds)
+        if reply.mel_tokens:
+            self.mel_token_counts.observe(reply.mel_tokens)
+        audio_seconds = reply.audio_seconds
+        with self.metrics_lock:
+            if reply.error is not None:
+                self.request_counts["error"] += 1
+                self.error_counts["deadline" if isinstance(reply.error, TimeoutError) else "synthesis"] += 1
+            else:
+                self.request_counts["cache_hit" if reply.cache_hit else "ok"] += 1
+            self.audio_seconds_total += audio_seconds
+        if audio_seconds > 0 and reply.error is None:
+            cost = reply.cost()
+            self.rtf.observe(cost["rtf"])
+            self.cost_windows.add(cost)
+        self.requests_observed += 1
+        if self.latency_report_every and self.requests_observed % self.latency_report_every == 0:
+            logger.info(f"Latency and cost summary over {self.requests_observed} requests", extra={"fields": {
+                "stage_p50_p99_ms": {
+                    stage: [histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000]
+                    for stage, histogram in self.stage_latency.items() if histogram.count},
+                "cost_windows": {f"{window:g}s": totals for window, totals in self.cost_windows.summary().items()},
+            }})
+
+    def render_metrics(self):
+        """All worker metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        def histogram_family(name, help_text, histograms):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in histograms:
+                cumulative, count, total = histogram.snapshot()
+                for bound, n in zip([f"{bound:g}" for bound in histogram.buckets] + ["+Inf"], cumulative):
+                    label_text = ",".join(f'{key}="{val}"' for key, val in dict(labels, le=bound).items())
+                    lines.append(f"{name}_bucket{{{label_text}}} {n}")
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{name}_sum{suffix} {total}")
+                lines.append(f"{name}_count{suffix} {count}")
+
+        with self.metrics_lock:
+            request_counts = dict(self.request_counts)
+            error_counts = dict(self.error_counts)
+            audio_seconds_total = self.audio_seconds_total
+        family("tts_requests_total", "counter", "Finished requests by outcome",
+               [({"outcome": outcome}, n) for outcome, n in request_counts.items()])
+        family("tts_request_errors_total", "counter", "Failed requests by kind",
+               [({"kind": kind}, n) for kind, n in error_counts.items()])
+        histogram_family("tts_stage_latency_seconds", "Per-request wall time by pipeline stage",
+                         [({"stage": stage}, histogram) for stage, histogram in self.stage_latency.items()])
+        histogram_family("tts_request_mel_tokens", "Mel tokens generated per request",
+                         [({}, self.mel_token_counts)])
+        histogram_family("tts_realtime_factor", "Synthesis seconds per second of audio",
+                         [({}, self.rtf)])
+        family("tts_audio_seconds_total", "counter", "Seconds of audio synthesized",
+               [({}, audio_seconds_total)])
+        window_samples = {field: [] for field in COST_FIELDS + ("requests", "rtf")}
+        for window, totals in self.cost_windows.summary().items():
+            for field in window_samples:
+                if totals[field] is not None:
+                    window_samples[field].append(({"window": f"{window:g}s"}, totals[field]))
+        family("tts_window_requests", "gauge", "Synthesized requests in the trailing window",
+               window_samples["requests"])
+        for field in COST_FIELDS:
+            family(f"tts_window_{field}", "gauge", f"Sum of per-request {field} in the trailing window",
+                   window_samples[field])
+        family("tts_window_realtime_factor", "gauge", "Synthesis seconds per audio second in the trailing window",
+               window_samples["rtf"])
+        family("tts_build_info", "gauge", "Versions behind the measured performance",
+               [({"torch": torch.__version__, "model_version": self.tts.model_version,
+                  "model_fingerprint": self.model_fingerprint[:12]}, 1)])
+        family("tts_sentences_generated_total", "counter", "Sentences decoded by the GPT",
+               [({}, self.sentences_generated)])
+        family("tts_sentences_truncated_total", "counter", "Sentences that hit the mel token cap",
+               [({}, self.sentences_truncated)])
+
+        cache_hits, cache_misses, cache_bytes = [], [], []
+        for name, cache in (("speaker", self.speaker_cache), ("sentence", self.sentence_cache)):
+            if cache is not None:
+                stats = cache.stats()
+                cache_hits.append(({"cache": name}, stats["hits"]))
+                cache_misses.append(({"cache": name}, stats["misses"]))
+                cache_bytes.append(({"cache": name}, stats["bytes"]))
+        if self.result_cache is not None:
+            stats = self.result_cache.stats()
+            cache_hits.append(({"cache": "result"}, stats["memory_hits"] + stats["disk_hits"]))
+            cache_misses.append(({"cache": "result"}, stats["misses"]))
+            cache_bytes.append(({"cache": "result", "tier": "memory"}, stats["memory_bytes"]))
+            cache_bytes.append(({"cache": "result", "tier": "disk"}, stats["disk_bytes"]))
+        family("tts_cache_hits_total", "counter", "Cache lookups that hit", cache_hits)
+        family("tts_cache_misses_total", "counter", "Cache lookups that missed", cache_misses)
+        family("tts_cache_bytes", "gauge", "Bytes held by each cache", cache_bytes)
+
+        family("tts_queue_depth", "gauge", "Requests waiting for the inference thread",
+               [({}, self.requests.qsize())])
+        family("tts_queue_capacity", "gauge", "Request queue size limit", [({}, self.requests.maxsize)])
+        family("tts_worker_state", "gauge", "Current worker state (1 for the active one)",
+               [({"state": state}, int(self.state == state))
+                for state in (STATE_LOADING, STATE_WARMING, STATE_READY, STATE_DRAINING, STATE_FAILED)])
+        family("tts_log_records_dropped_total", "counter", "Log records dropped because the log queue was full",
+               [({}, sum(getattr(handler, "dropped", 0) for handler in logging.getLogger().handlers))])
+        family("process_resident_memory_bytes", "gauge", "Resident memory of the worker process",
+               [({}, process_memory_bytes())])
+        if self.autocast_device == "cuda":
+            device = torch.device(self.tts.device)
+            family("tts_gpu_memory_allocated_bytes", "gauge", "GPU memory held by tensors",
+                   [({"device": str(device)}, torch.cuda.memory_allocated(device))])
+            family("tts_gpu_memory_reserved_bytes", "gauge", "GPU memory reserved by the caching allocator",
+                   [({"device": str(device)}, torch.cuda.memory_reserved(device))])
+            family("tts_gpu_memory_peak_bytes", "gauge", "Peak GPU memory held by tensors",
+                   [({"device": str(device)}, torch.cuda.max_memory_allocated(device))])
+        return "\n".join(lines) + "\n"
+
+    def _start_metrics_server(self):
+        """Serve /metrics from a daemon thread"""
+        metrics_server = http.server.ThreadingHTTPServer(("", self.metrics_port), MetricsHandler)
+        metrics_server.daemon_threads = True
+        metrics_server.tts_server = self
+        threading.Thread(target=metrics_server.serve_forever, name="tts-metrics", daemon=True).start()
+        logger.info(f"Metrics endpoint: http://0.0.0.0:{self.metrics_port}/metrics")
+
+    def _get_conditioning(self, voice_file):
+        """Conditioning mel for the reference audio: load, resample and mel-encode it only on a cache miss"""
+        key = self.voice_hash(voice_file)
+        cond_mel = self.speaker_cache.get(key)
+        if cond_mel is None:
+            start_time = time.perf_counter()
+            audio, sr = torchaudio.load(voice_file)
+            audio = torch.mean(audio, dim=0, keepdim=True)
+            # Cached entries serve every preset, so compute them in FP32 even under a bf16
+            # preset's CPU autocast (the resample and mel run on the CPU tensor torchaudio loads)
+            with torch.amp.autocast("cpu", enabled=False):
+                audio = torchaudio.transforms.Resample(sr, SAMPLING_RATE)(audio)
+                cond_mel = MelSpectrogramFeatures()(audio).float().to(self.tts.device)
+            self.speaker_cache.put(key, cond_mel)
+            stats = self.speaker_cache.stats()
+            logger.info(f"Speaker conditioning computed for {voice_file} in {time.perf_counter() - start_time:.2f}s "
+                        f"(cache hits={stats['hits']} misses={stats['misses']} entries={stats['entries']})")
+        return cond_mel
+
+    def synthesize_batch(self, replies, use_cache=True):
+        """Synthesize several requests together, yielding reply frames as they become ready.
+
+        Requests found in the result cache are answered first; the rest are grouped by
+        reference voice and preset, and each group is synthesized together, see _synthesize_group.
+        """
+        groups = {}
+        for reply in replies:
+            if reply.deadline is not None and time.time() > reply.deadline:
+                logger.warning("Request deadline passed before synthesis, skipping",
+                               extra={"request_id": reply.request_id})
+                reply.error = TimeoutError("deadline exceeded")
+                yield from reply.final_frames()
+                continue
+            try:
+                voice_key = self.voice_hash(reply.voice_file)
+            except OSError as e:
+                logger.error(f"Cannot read voice file {reply.voice_file}: {e}", extra={"request_id": reply.request_id})
+                reply.error = e
+                yield from reply.final_frames()
+                continue
+            preset = reply.preset or self.default_preset
+            params = self.presets[preset]
+            if use_cache and self.result_cache is not None and not params["do_sample"]:
+                reply.cache_key = AudioResultCache.make_key(
+                    reply.text_data, voice_key,
+                    dict(params, **self.mel_token_settings, silence_samples=reply.silence_samples,
+                         format=reply.output_format, sample_rate=reply.sample_rate),
+                    self.model_fingerprint)
+                audio_data = self.result_cache.get(reply.cache_key)
+                if audio_data is not None:
+                    yield from reply.cached_frames(audio_data)
+                    continue
+            groups.setdefault((voice_key, preset), []).append(reply)
+
+        for (_, preset), group in groups.items():
+            params = self.presets[preset]
+            try:
+                with self._inference_context(params["precision"]):
+                    yield from self._synthesize_group(group[0].voice_file, group, params,
+                                                      use_cache and not params["do_sample"])
+            except Exception as e:
+                logger.exception(f"Exception during IndexTTS processing: {e}")
+                for reply in group:
+                    if not reply.done:
+                        reply.error = e
+            for reply in group:
+                if not reply.finished:
+                    yield from self._complete(reply)
+
+    def _complete(self, reply):
+        """Final frames of a reply, then its result cache entry"""
+        yield from reply.final_frames()
+        # Runs after the frames above have been handed off for sending
+        if reply.cache_key and reply.error is None and reply.wavs:
+            self.result_cache.put(reply.cache_key, reply.audio_data())
+
+    def _sentence_cache_key(self, sent, voice_key, params):
+        blob = json.dumps([sent, voice_key, dict(params, **self.mel_token_settings), self.model_fingerprint],
+                          sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _mel_token_cap(self, text_token_count, params):
+        if not self.adaptive_mel_tokens:
+            return params["max_mel_tokens"]
+        cap = math.ceil(text_token_count * self.mel_tokens_per_text_token * (1 + self.mel_token_margin))
+        return min(params["max_mel_tokens"], max(self.min_mel_tokens, cap))
+
+    def _synthesize_group(self, voice_file, replies, params, use_cache=True):
+        """Run the infer_fast pipeline (GPT codes -> GPT latents -> BigVGAN) over the pooled
+        sentences of all replies, yielding stream chunks as sentences complete.
+
+        Sentences found in the sentence cache are used as-is and only the misses are
+        synthesized. Sentences from different requests are bucketed together: by token
+        length like infer_fast does, or by sentence position when a reply is streaming
+        so every stream's first chunk comes out of the first bucket. A reply is completed
+        as soon as its last sentence is in, without waiting for the rest of the group.
+        """
+        tts = self.tts
+        with self._timed_stage("conditioning", replies):
+            cond_mel = self._get_conditioning(voice_file)
+        cond_mel_lengths = torch.tensor([cond_mel.shape[-1]], device=tts.device)
+        use_sentence_cache = use_cache and self.sentence_cache is not None
+        voice_key = self.voice_hash(voice_file)
+
+        items = []
+        for reply in replies:
+            normalize_before = self._normalize_seconds
+            start_time = time.perf_counter()
+            text_tokens_list = tts.tokenizer.tokenize(reply.text_data)
+            sentences = tts.tokenizer.split_sentences(
+                text_tokens_list, max_tokens_per_sentence=params["max_text_tokens_per_sentence"])
+            normalize_seconds = self._normalize_seconds - normalize_before
+            reply.add_stage("normalize", normalize_seconds)
+            reply.add_stage("tokenize", time.perf_counter() - start_time - normalize_seconds)
+            reply.text_tokens = len(text_tokens_list)
+            reply.sentence_count = len(sentences)
+            for idx, sent in enumerate(sentences):
+                item = {"reply": reply, "idx": idx, "sent": sent, "len": len(sent), "cache_key": None}
+                if use_sentence_cache:
+                    item["cache_key"] = self._sentence_cache_key(sent, voice_key, params)
+                    wav_data = self.sentence_cache.get(item["cache_key"])
+                    if wav_data is not None:
+                        yield from reply.add(idx, wav_data)
+                        continue
+                items.append(item)
+            if reply.done:
+                # Empty text, or every sentence came from the sentence cache
+                yield from self._complete(reply)
+        if use_sentence_cache:
+            stats = self.sentence_cache.stats()
+            logger.debug(f"Sentence cache: {len(items)} sentences to synthesize, "
+                         f"hit rate {stats['hit_rate']:.1%} ({stats['entries']} entries)")
+
+        if any(reply.stream for reply in replies):
+            items.sort(key=lambda item: (item["idx"], item["len"]))
+        else:
+            items.sort(key=lambda item: item["len"])
+        # infer_fast does not batch on CPU either
+        bucket_max_size = params["sentences_bucket_max_size"] if tts.device != "cpu" else 1
+
+        for start in range(0, len(items), bucket_max_size):
+            bucket = items[start:start + bucket_max_size]
+            bucket_replies = list({id(item["reply"]): item["reply"] for item in bucket}.values())
+            # Bucket time is charged to each request by its number of sentences in the bucket
+            bucket_sentences = [sum(item["reply"] is reply for item in bucket) for reply in bucket_replies]
+            with self._timed_stage("tokenize", bucket_replies, bucket_sentences):
+                text_tokens = [
+                    torch.tensor(tts.tokenizer.convert_tokens_to_ids(item["sent"]), dtype=torch.int32,
+                                 device=tts.device).unsqueeze(0)
+                    for item in bucket
+                ]
+                batch_text_tokens = tts.pad_tokens_cat(text_tokens) if len(text_tokens) > 1 else text_tokens[0]
+            # generate() takes one length limit per batch, so the longest sentence sets it
+            max_mel_tokens = self._mel_token_cap(max(item["len"] for item in bucket), params)
+            with self._timed_stage("gpt_decode", bucket_replies, bucket_sentences):
+                batch_codes = tts.gpt.inference_speech(
+                    cond_mel, batch_text_tokens,
+                    cond_mel_lengths=cond_mel_lengths,
+                    do_sample=params["do_sample"],
+                    top_p=params["top_p"],
+                    top_k=params["top_k"],
+                    temperature=params["temperature"],
+                    num_return_sequences=1,
+                    length_penalty=params["length_penalty"],
+                    num_beams=params["num_beams"],
+                    repetition_penalty=params["repetition_penalty"],
+                    max_generate_length=max_mel_tokens,
+                )
+            for item, tokens, codes in zip(bucket, text_tokens, batch_codes):
+                self.sentences_generated += 1
+                stops = (codes == tts.stop_mel_token).nonzero()
+                item["reply"].mel_tokens += int(stops[0]) + 1 if len(stops) else len(codes)
+                if codes[-1] != tts.stop_mel_token:
+                    self.sentences_truncated += 1
+                    logger.warning(f"Sentence hit the mel token cap ({max_mel_tokens} for {item['len']} text tokens); "
+                                   f"{self.sentences_truncated}/{self.sentences_generated} sentences truncated so far",
+                                   extra={"request_id": item["reply"].request_id})
+                with self._timed_stage("gpt_latent", [item["reply"]]):
+                    codes, code_lens = tts.remove_long_silence(codes.unsqueeze(0), silent_token=52, max_consecutive=30)
+                    latent = tts.gpt(
+                        cond_mel, tokens, torch.tensor([tokens.shape[-1]], device=tts.device),
+                        codes, code_lens * tts.gpt.mel_length_compression,
+                        cond_mel_lengths=cond_mel_lengths, return_latent=True, clip_inputs=False)
+                with self._timed_stage("vocoder", [item["reply"]]):
+                    if params["precision"] == "bf16":
+                        # bf16 keeps only 8 mantissa bits, which is audible in a waveform, so the vocoder stays FP32
+                        with torch.amp.autocast(self.autocast_device, enabled=False):
+                            wav, _ = tts.bigvgan(latent.float(), cond_mel.transpose(1, 2).float())
+                    else:
+                        wav, _ = tts.bigvgan(latent, cond_mel.transpose(1, 2))
+                    wav = torch.clamp(32767 * wav.float().squeeze(1), -32767.0, 32767.0)
+                    wav_data = wav.cpu().type(torch.int16).numpy().reshape(-1)
+                if item["cache_key"]:
+                    self.sentence_cache.put(item["cache_key"], wav_data)
+                yield from item["reply"].add(item["idx"], wav_data)
+                if item["reply"].done:
+                    yield from self._complete(item["reply"])
+
+    def _write_debug_wav(self, output_file, audio_data):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with open(output_file, 'wb') as audio_file:
+            audio_file.write(audio_data)
+
+    def _collect_batch(self):
+        """Block for one request, then gather more that arrive within the batching window"""
+        replies = [self.requests.get()]
+        deadline = time.perf_counter() + self.batch_window_ms / 1000
+        while len(replies) < self.batch_max_requests:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    replies.append(self.requests.get(timeout=remaining))
                 else:
-                    audio_data = b""
+                    replies.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return replies
 
-                self.socket.send_multipart(message[:3] + [audio_data])
+    def _resolve_voice(self, voice_id):
+        """Map a request's voice id to <INDEX_TTS_VOICE_DIR>/<id>.wav"""
+        if not self.voice_dir:
+            raise ValueError("voice selection is not enabled (INDEX_TTS_VOICE_DIR is unset)")
+        voice_id = str(voice_id)
+        if os.path.basename(voice_id) != voice_id or voice_id.startswith("."):
+            raise ValueError(f"invalid voice id: {voice_id!r}")
+        voice_file = os.path.join(self.voice_dir, voice_id + ".wav")
+        if not os.path.exists(voice_file):
+            raise ValueError(f"unknown voice: {voice_id!r}")
+        return voice_file
 
-                try:
-                    os.remove(temp_audio_path)
-                    os.rmdir(temp_dir)
-                except Exception as e:
-                    print(f"Warning: Failed to clean up temp files: {str(e)}")
+    def _make_reply(self, message):
+        request = parse_payload(message[3])
+        text_data = request["text"]
+        stream = bool(request.get("stream", self.streaming or message[4:5] == [STREAM_REQUEST_FLAG]))
+        voice_file = self._resolve_voice(request["voice"]) if request.get("voice") else self.default_voice
+
+        output_format = str(request.get("format", "wav")).lower()
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"unsupported format {output_format!r}, expected one of {OUTPUT_FORMATS}")
+        sample_rate = int(request.get("sample_rate", SAMPLING_RATE))
+        if not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+            raise ValueError(f"sample_rate must be between {MIN_SAMPLE_RATE} and {MAX_SAMPLE_RATE}")
+        deadline = request.get("deadline")
+        preset = request.get("preset")
+        if preset is not None and preset not in self.presets:
+            raise ValueError(f"unknown preset {preset!r}")
+
+        request_id = str(request.get("request_id") or os.urandom(8).hex())
+        logger.debug("Received text data for synthesis", extra={"request_id": request_id, "fields": dict(
+            text_fields(text_data), voice=voice_file, stream=stream, format=output_format, preset=preset)})
+        return PendingReply(message[:3], text_data, voice_file, stream=stream,
+                            silence_samples=self.sentence_silence_samples,
+                            output_format=output_format, sample_rate=sample_rate,
+                            preset=preset,
+                            deadline=float(deadline) if deadline is not None else None,
+                            metadata=bool(request.get("metadata", False)),
+                            request_id=request_id)
+
+    def _inference_loop(self):
+        """Inference thread: synthesize queued requests and push reply frames to the I/O thread"""
+        reply_sender = self.context.socket(zmq.PAIR)
+        reply_sender.connect(REPLY_PIPE_URL)
+        while True:
+            logger.debug("IndexTTS server is ready to receive a message ...")
+            replies = self._collect_batch()
+            picked_up = time.perf_counter()
+            for reply in replies:
+                reply.add_stage("queue_wait", picked_up - reply.received_at)
+            try:
+                if len(replies) > 1:
+                    logger.debug(f"Batching {len(replies)} requests")
+
+                start_time = time.perf_counter()
+                with self._profiled(replies):
+                    for frames in self.synthesize_batch(replies):
+                        reply_sender.send_multipart(frames)
+                logger.debug(f"IndexTTS inference completed in {time.perf_counter() - start_time:.2f} seconds")
+
+                for reply in replies:
+                    fields = {"stages_ms": reply.stages_ms(), "cost": reply.cost()}
+                    if reply.error is not None:
+                        logger.error(f"Error in text processing: {reply.error}",
+                                     extra={"request_id": reply.request_id, "fields": fields})
+                    else:
+                        logger.info("Served from result cache" if reply.cache_hit else "Text processed successfully!",
+                                    extra={"request_id": reply.request_id, "sampled": True, "fields": fields})
+                    self._record_metrics(reply)
+                    # Debug mode keeps a copy of every response on disk
+                    if self.debug_wav_dir and reply.error is None and reply.audio_data():
+                        temp_dir = tempfile.mkdtemp(dir=self.debug_wav_dir)
+                        self._write_debug_wav(os.path.join(temp_dir, "response.wav"), reply.audio_data())
+                if self.result_cache is not None:
+                    stats = self.result_cache.stats()
+                    logger.debug(f"Result cache hit rate {stats['hit_rate']:.1%} "
+                                 f"(memory={stats['memory_hits']} disk={stats['disk_hits']} misses={stats['misses']})")
 
             except Exception as e:
-                error_msg = f"Error processing request: {str(e)}"
-                print(error_msg)
-                self.socket.send_multipart(message[:3] + [b""])
+                logger.exception(f"Error processing request: {str(e)}")
+                for reply in replies:
+                    if not reply.finished:
+                        reply.error = e
+                        reply_sender.send_multipart(reply.final_frames()[0])
+            finally:
+                for _ in replies:
+                    self.requests.task_done()
+
+    def _forward_replies(self):
+        while True:
+            try:
+                frames = self.reply_receiver.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            start_time = time.perf_counter()
+            self.socket.send_multipart(frames)
+            self.stage_latency["send"].observe(time.perf_counter() - start_time)
+
+    def _handle_monitor_event(self):
+        event = recv_monitor_message(self.monitor)
+        if event["event"] == zmq.EVENT_CONNECTED:
+            # The first connect delivers the registration queued by register(); any later
+            # connect means the broker came back and has forgotten this worker
+            if self.connected_once:
+                logger.info("Reconnected to broker, re-registering")
+                self.register()
+            self.connected_once = True
+        elif event["event"] == zmq.EVENT_DISCONNECTED:
+            logger.warning(f"Disconnected from broker {self.url}")
+
+    def _check_heartbeat(self, now):
+        """Send due heartbeats; rebuild the socket if the broker has been silent too long"""
+        if now - self.last_heartbeat_sent >= self.heartbeat_interval:
+            self.socket.send_multipart([self.service_name.encode(), HEARTBEAT])
+            self.last_heartbeat_sent = now
+        silence = now - self.last_received
+        if silence > self.heartbeat_interval * self.heartbeat_liveness + self.reconnect_backoff:
+            logger.warning(f"No traffic from broker for {silence:.0f}s, reconnecting")
+            self.poller.register(self.socket, 0)  # unregister, if registered
+            self.poller.unregister(self.monitor)
+            self._reconnect()
+            self.poller.register(self.monitor, zmq.POLLIN)
+            self.last_received = now
+            self.reconnect_backoff = min(self.reconnect_backoff * 2, self.MAX_RECONNECT_BACKOFF)
+
+    def _io_loop(self):
+        """I/O thread: owns the DEALER socket, queues decoded requests and forwards replies"""
+        poller = self.poller = zmq.Poller()
+        poller.register(self.reply_receiver, zmq.POLLIN)
+        poller.register(self.monitor, zmq.POLLIN)
+        if self.admin_socket is not None:
+            poller.register(self.admin_socket, zmq.POLLIN)
+        self.last_received = self.last_heartbeat_sent = time.monotonic()
+        drain_deadline = None
+        while True:
+            if self.state == STATE_DRAINING:
+                if drain_deadline is None:
+                    drain_deadline = time.monotonic() + self.drain_timeout
+                    logger.info(f"Draining: finishing {self.requests.unfinished_tasks} queued requests")
+                # Requests count as unfinished until their replies have been handed to this thread
+                if self.requests.unfinished_tasks == 0 or time.monotonic() > drain_deadline:
+                    self._forward_replies()
+                    # The broker may still have routed requests here; answer them before closing
+                    while True:
+                        try:
+                            message = self.socket.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            return
+                        self._reject_draining(message)
+                # Keep reading so requests routed here during the drain get an error reply
+                poller.register(self.socket, zmq.POLLIN)
+            else:
+                # Back-pressure: leave new requests with the broker while the queue is full
+                poller.register(self.socket, 0 if self.requests.full() else zmq.POLLIN)
+            events = dict(poller.poll(100))
+
+            if self.reply_receiver in events:
+                self._forward_replies()
+
+            if self.monitor in events:
+                self._handle_monitor_event()
+
+            if self.admin_socket is not None and self.admin_socket in events:
+                self._handle_admin()
+
+            if self.socket in events:
+                message = self.socket.recv_multipart()
+                self.last_received = time.monotonic()
+                self.reconnect_backoff = self.MIN_RECONNECT_BACKOFF
+                if self.state == STATE_DRAINING:
+                    self._reject_draining(message)
+                elif len(message) >= 4:  # shorter messages are broker heartbeats / control frames
+                    try:
+                        self.requests.put_nowait(self._make_reply(message))
+                    except Exception as e:
+                        logger.warning(f"Rejected invalid request: {str(e)}")
+                        with self.metrics_lock:
+                            self.error_counts["invalid_request"] += 1
+                        self.socket.send_multipart(message[:3] + [b""])
+
+            if self.heartbeat_interval > 0:
+                self._check_heartbeat(time.monotonic())
+
+    def _reject_draining(self, message):
+        """Answer a request that arrived while draining with the usual error reply
+        (an empty WAV, or an ERROR frame for streams) so the client can retry elsewhere"""
+        if len(message) < 4:
+            return
+        with self.metrics_lock:
+            self.error_counts["draining"] += 1
+        try:
+            reply = self._make_reply(message)
+        except Exception:
+            self.socket.send_multipart(message[:3] + [b""])
+            return
+        logger.warning("Rejected request received while draining", extra={"request_id": reply.request_id})
+        reply.error = RuntimeError("worker is draining")
+        self.socket.send_multipart(reply.final_frames()[0])
+
+    def _drain(self, signum, frame):
+        if self.state == STATE_READY:
+            self._set_state(STATE_DRAINING)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._drain)
+        inference_thread = threading.Thread(target=self._inference_loop, name="tts-inference", daemon=True)
+        inference_thread.start()
+        if self.metrics_port:
+            self._start_metrics_server()
+        self.register()
+        self._set_state(STATE_READY)
+        self._io_loop()
+        logger.info("IndexTTS worker drained, shutting down")
+        self.socket.disable_monitor()
+        self.socket.close(linger=1000)
+        if self.admin_socket is not None:
+            self.admin_socket.close(linger=0)
+
+def _worker_main(worker_id, device, num_threads, tts=None):
+    """Entry point of one supervised worker process"""
+    # A forked worker inherits the supervisor's signal handlers, and needs its own log writer thread
+    listener = setup_logging()
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        os.environ['DEVICE'] = device
+        os.environ['INDEX_TTS_WORKER_ID'] = str(worker_id)
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        logger.info(f"Worker {worker_id} (pid {os.getpid()}) starting on {device}"
+                    + (" with the pre-forked model" if tts is not None else ""))
+        server = IndexTtsServer(tts=tts)
+        server.run()
+    except Exception:
+        logger.exception(f"Worker {worker_id} crashed")
+        raise
+    finally:
+        # Forked workers leave through os._exit, which skips atexit: flush queued records now
+        atexit.unregister(listener.stop)
+        listener.stop()
+
+
+class WorkerSupervisor:
+    """Runs N worker processes, each with its own IndexTTS replica and DEALER socket,
+    and restarts any that exit.
+
+    In pre-fork mode (CPU only) the supervisor loads IndexTTS once and forks the
+    workers, which share its weights copy-on-write instead of loading a replica each.
+    """
+
+    # Restart backoff doubles while a worker keeps crashing shortly after start
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, num_workers, devices, num_threads, prefork=False):
+        self.num_workers = num_workers
+        self.devices = devices
+        self.num_threads = num_threads
+        self.prefork = prefork
+        self.tts = None
+        # spawn, not fork: CUDA cannot be re-initialized in a forked child. Pre-fork
+        # mode is CPU only and forks before any worker creates a ZMQ context.
+        self.mp_context = multiprocessing.get_context("fork" if prefork else "spawn")
+        self.workers = {}
+        self.backoff = {}
+        self.stopping = False
+
+    def _load_shared_model(self):
+        """Load IndexTTS in the supervisor for the forked workers to share"""
+        # A single intra-op thread while loading, so no OpenMP pool exists for the
+        # children to inherit; each worker sets its own thread count after the fork
+        torch.set_num_threads(1)
+        snapshot_dir = os.environ.get('INDEX_TTS_SNAPSHOT_DIR')
+        model_dir = snapshot_dir or os.environ.get('INDEX_TTS_MODEL_DIR', os.path.join(current_dir, "checkpoints"))
+        missing = missing_model_files(model_dir, snapshot=bool(snapshot_dir))
+        if missing:
+            raise FileNotFoundError(f"Missing {len(missing)} required file(s): {', '.join(missing)}")
+        timings = OrderedDict()
+        self.tts = load_indextts(model_dir, "cpu", timings,
+                                 parallel=os.environ.get('INDEX_TTS_PARALLEL_LOAD', '0') == '1',
+                                 snapshot=bool(snapshot_dir))
+        # Move everything allocated so far out of the collector's reach, so collections in
+        # the workers do not write to (and un-share) the pages holding these objects
+        gc.collect()
+        gc.freeze()
+        logger.info(f"Loaded shared IndexTTS model in {timings['model_load']:.1f}s, forking workers")
+
+    def _start_worker(self, worker_id):
+        device = self.devices[worker_id % len(self.devices)]
+        process = self.mp_context.Process(
+            target=_worker_main, args=(worker_id, device, self.num_threads, self.tts),
+            name=f"tts-worker-{worker_id}", daemon=False)
+        process.start()
+        self.workers[worker_id] = (process, time.monotonic())
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        if self.prefork:
+            self._load_shared_model()
+        logger.info(f"Starting {self.num_workers} IndexTTS workers on {', '.join(self.devices)}")
+        for worker_id in range(self.num_workers):
+            self._start_worker(worker_id)
+
+        restart_at = {}
+        while not self.stopping:
+            time.sleep(0.5)
+            now = time.monotonic()
+            for worker_id, (process, started) in list(self.workers.items()):
+                if process.is_alive() or worker_id in restart_at:
+                    continue
+                backoff = self.backoff.get(worker_id, self.MIN_BACKOFF)
+                # A worker that stayed up for a while gets a fresh backoff
+                if now - started > self.MAX_BACKOFF:
+                    backoff = self.MIN_BACKOFF
+                logger.warning(f"Worker {worker_id} exited with code {process.exitcode}, restarting in {backoff:.0f}s")
+                restart_at[worker_id] = now + backoff
+                self.backoff[worker_id] = min(backoff * 2, self.MAX_BACKOFF)
+            for worker_id, when in list(restart_at.items()):
+                if now >= when:
+                    del restart_at[worker_id]
+                    self._start_worker(worker_id)
+
+        logger.info("Stopping IndexTTS workers...")
+        for process, _ in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in self.workers.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+
+
+def _worker_plan():
+    """(worker count, devices, threads per worker) from INDEX_TTS_WORKERS / DEVICE.
+
+    "auto" starts one worker per visible GPU, or on CPU one worker per
+    INDEX_TTS_THREADS_PER_WORKER cores.
+    """
+    workers = os.environ.get('INDEX_TTS_WORKERS', '1')
+    threads_per_worker = int(os.environ.get('INDEX_TTS_THREADS_PER_WORKER', '0'))
+    device = os.environ.get('DEVICE', "cuda" if torch.cuda.is_available() else "cpu")
+
+    if device.startswith("cuda") and torch.cuda.is_available():
+        if device == "cuda":
+            devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        else:
+            devices = [device]
+        default_workers = len(devices)
+    else:
+        devices = ["cpu"]
+        threads_per_worker = threads_per_worker or 4
+        default_workers = max(1, len(os.sched_getaffinity(0)) // threads_per_worker)
+
+    num_workers = default_workers if workers == "auto" else max(1, int(workers))
+    return num_workers, devices, threads_per_worker
+
 
 def main():
-    sys.stdout = sys.stderr
-    server = IndexTtsServer()
-    server.run()
+    setup_logging()
+    num_workers, devices, num_threads = _worker_plan()
+    if num_workers == 1:
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        server = IndexTtsServer()
+        server.run()
+    else:
+        prefork = os.environ.get('INDEX_TTS_PREFORK', '0') == '1'
+        if prefork and devices != ["cpu"]:
+            logger.warning("INDEX_TTS_PREFORK only applies to CPU workers, spawning independent GPU workers")
+            prefork = False
+        WorkerSupervisor(num_workers, devices, num_threads, prefork=prefork).run()
 
 if __name__ == "__main__":
     main()